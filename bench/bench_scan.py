@@ -0,0 +1,74 @@
+"""Filter-only scan over a big todo file, eager vs lazy parsing.
+
+Loads a generated file with TodoFile and counts the open tasks created since
+a date - which only needs the done mark and the dates - then the same with a
+due: tag check on the ones that pass, which makes lazy tasks decode. Prints
+the median time of each.
+
+    python bench/bench_scan.py [lines] [runs]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+from datetime import date, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from todo import TodoFile
+
+def setup(tdir, nlines):
+    fname = os.path.join(tdir, "todo.txt")
+    start = date(2010, 1, 1)
+    with open(fname, 'w') as fd:
+        for n in range(nlines):
+            created = start + timedelta(days=n % 1500)
+            line = "%s task number %d with some words +proj%d @ctx%d due:%s" % (
+                    created, n, n % 7, n % 3, created + timedelta(days=7))
+            if n % 4 == 0:
+                line = "x %s %s" % (created + timedelta(days=1), line)
+            elif n % 5 == 0:
+                line = "(B) " + line
+            fd.write(line + "\n")
+    return fname
+
+def scan(fname, lazy, since, tag):
+    tf = TodoFile(fname, lazy=lazy)
+    tf.open()
+    count = 0
+    for task in tf.tasks:
+        if task.done or task.create < since:
+            continue
+        if tag and tag not in task.tags:
+            continue
+        count += 1
+    return count
+
+def median(vals):
+    vals = sorted(vals)
+    return vals[len(vals) // 2]
+
+def main():
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    since = date(2013, 6, 1)
+    tdir = tempfile.mkdtemp()
+    try:
+        fname = setup(tdir, nlines)
+        for name, tag in (("done+create", None), ("done+create+tag", "due")):
+            for lazy in (False, True):
+                times = []
+                for _ in range(runs):
+                    start = time.time()
+                    count = scan(fname, lazy, since, tag)
+                    times.append(time.time() - start)
+                print("%-16s %-6s %7.1f ms  (%d tasks)" % (name,
+                      "lazy" if lazy else "eager", median(times) * 1000, count))
+    finally:
+        shutil.rmtree(tdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Time to first output for the checklist command.
+
+Runs `python -m checklists ls` and a `process` that has nothing to do against
+a throwaway TODO_DIR, both as a plain command and the way todo.sh runs it as
+an add-on (with its settings already exported), and prints the median time
+until the first byte of output / exit.
+
+    python bench/bench_startup.py [runs]
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import time
+from datetime import date
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+def setup(tdir, nitems=50):
+    cfg = os.path.join(tdir, "todo.cfg")
+    with open(cfg, 'w') as fd:
+        fd.write("export TODO_DIR=%s\n" % (tdir,))
+    items = [{"type": "daily", "id": "item%d" % n, "text": "item %d" % n}
+             for n in range(nitems)]
+    with open(os.path.join(tdir, "checklist.json"), 'w') as fd:
+        json.dump(items, fd)
+    # every item already has today's task, so processing changes nothing
+    with open(os.path.join(tdir, "todo.txt"), 'w') as fd:
+        for n in range(nitems):
+            fd.write("%s item %d checklist:item%d\n" % (date.today(), n, n))
+    open(os.path.join(tdir, "done.txt"), 'w').close()
+    return cfg
+
+def first_output(args, env):
+    start = time.time()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, env=env, cwd=ROOT)
+    # process prints nothing, so its first output is the end of the run
+    proc.stdout.read(1)
+    first = time.time() - start
+    proc.communicate()
+    return first
+
+def median(vals):
+    vals = sorted(vals)
+    return vals[len(vals) // 2]
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    tdir = tempfile.mkdtemp()
+    try:
+        cfg = setup(tdir)
+        plain = dict(os.environ, PYTHONPATH=ROOT)
+        addon = dict(plain, TODOTXT_CFG_FILE=cfg, TODO_DIR=tdir)
+        base = [sys.executable, "-m", "checklists", "-c", cfg]
+        for cmd in ("ls", "process"):
+            for name, env in (("plain", plain), ("todo.sh add-on", addon)):
+                times = [first_output(base + [cmd], env) for _ in range(runs)]
+                print("%-8s %-15s %7.1f ms" % (cmd, name, median(times) * 1000))
+    finally:
+        shutil.rmtree(tdir)
+
+if __name__ == '__main__':
+    main()
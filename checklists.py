@@ -1,12 +1,14 @@
 # Checklist todo: add additional commands... e.g.
 # list, add, remove, and so on
 
+# calendar, uuid and argparse are imported where they are used - they are
+# slow to load and most runs (ls, process) never need them
+import os
 import json
-import calendar
-import uuid
 from datetime import datetime, date, timedelta
 from operator import attrgetter
-import argparse
+from collections import OrderedDict
+from itertools import islice
 
 from todo import Task, TodoFile, get_todo_env
 import todo
@@ -23,6 +25,7 @@ def parse_day(day):
         return day
     except: #need to string parse
         if _lookup is None:
+            import calendar
             _lookup = dict()
             for n, v in enumerate(calendar.day_abbr):
                 _lookup[v.lower()] = n
@@ -39,16 +42,18 @@ class ChecklistItem(object):
         # if no id is provided, just use one
         self.id = kw.get('id', None)
         if self.id is None:
+            import uuid
             self.id = uuid.uuid4()
         self.text = kw.get('text','')
 
     def __str__(self):
         args = []
         for k, v in self.__dict__.iteritems():
-            if k != "id" and k != 'text':
+            if k != "id" and k != 'text' and not k.startswith('_'):
                 # stupid special cases... rethink...
                 if k.startswith("day"):
                     if k == "day_of_week":
+                        import calendar
                         v = calendar.day_abbr[v].lower()
                     k = "day"
                 args.append("%s: %s" % (k, v))
@@ -58,38 +63,54 @@ class ChecklistItem(object):
             args = "\n\t" + args
         return "%s<%s>: %s%s" % (self.__class__.__name__, self.id, self.text, args)
 
-    def past_due(self, latest_task):
+    def due_date(self, latest_task):
+        """The last day to do latest_task in - it is past due the day after"""
         raise NotImplemented("This is for subclasses silly")
 
-    def schedule_next(self, latest_task):
+    def past_due(self, latest_task, today=None):
+        due = self.due_date(latest_task)
+        if due is None:
+            return False
+        return ((today or get_today()) - due).days >= 1
+
+    def schedule_next(self, latest_task, today=None):
+        """True if a new task should be made today (get_today() if not
+        given)"""
         raise NotImplemented("This is for subclasses silly")
 
-    def process(self, latest_task):
-        new_task = Task(self.text, tags = {"checklist":self.id}, autodate=True)
+    def _new_task(self):
+        return Task(self.text, tags = {"checklist":self.id}, autodate=True)
 
-        if latest_task is None and self.schedule_next(None):
-            return new_task
+    def process(self, latest_task):
+        if latest_task is None:
+            if self.schedule_next(None):
+                return self._new_task()
+            return
 
         # task is not fully processed
         if not self.task_ended(latest_task):
             if not self.past_due(latest_task):
                 return
-
-            # if it isn't but it is done - process it ...
-            if latest_task.done:
-                status = latest_task.tags['checklist'].partition('_')[2]
-                if not status:
-                    latest_task.tags['checklist'] = "%s_%s" % (self.id, 'complete')
-            #otherwise process it incomplete
-            else:
-                latest_task.do()
-                latest_task.tags['checklist'] = "%s_%s" % (self.id, 'incomplete')
+            self._end(latest_task)
 
         # ... and schedule a new one
         # with scheduled checklist tasks - there can be only one, hence the
         # ended check above
         if self.schedule_next(latest_task):
-            return new_task
+            return self._new_task()
+
+    def _end(self, latest_task):
+        """Mark a past due task complete if it is done, otherwise do it and
+        mark it incomplete"""
+        if latest_task.done:
+            status = latest_task.tags['checklist'].partition('_')[2]
+            if not status:
+                latest_task.tags['checklist'] = "%s_%s" % (self.id, 'complete')
+                latest_task.changed()
+        else:
+            latest_task.do()
+            latest_task.tags['checklist'] = "%s_%s" % (self.id, 'incomplete')
+            latest_task.changed()
 
     def toJSON(self):
         res = {}
@@ -112,16 +133,13 @@ class Daily(ChecklistItem):
     def __init__(self, **kw):
         super(Daily, self).__init__(**kw)
 
-    def past_due(self, latest_task):
-        today = get_today()
-        if (today - latest_task.create).days >= 1:
-            return True
-        return False
+    def due_date(self, latest_task):
+        return latest_task.create
 
-    def schedule_next(self, latest_task):
+    def schedule_next(self, latest_task, today=None):
         if latest_task is None:
             return True
-        return self.past_due(latest_task)
+        return self.past_due(latest_task, today)
 
     def toJSON(self):
         res =  super(Daily, self).toJSON()
@@ -136,16 +154,11 @@ class Weekly(ChecklistItem):
         # keep the math simple in sched -- never conflict
         self.complete_time = max(min(int(kw.get('complete_time', 1)), 7) - 1, 0)
 
-    def past_due(self, latest_task):
-        today = get_today()
-        due = latest_task.create + timedelta(days=self.complete_time)
-        if (today - due).days >= 1:
-            return True
-        else:
-            return False
+    def due_date(self, latest_task):
+        return latest_task.create + timedelta(days=self.complete_time)
 
-    def schedule_next(self, latest_task):
-        today = get_today()
+    def schedule_next(self, latest_task, today=None):
+        today = today or get_today()
         if today.weekday() == self.day_of_week:
             return True
         return False
@@ -153,11 +166,13 @@ class Weekly(ChecklistItem):
     def toJSON(self):
         res =  super(Weekly, self).toJSON()
         res['type'] = 'weekly'
+        import calendar
         res['day'] = calendar.day_abbr[self.day_of_week].lower()
         res['complete_time'] = self.complete_time + 1
         return res
 
 def add_months(sourcedate,months):
+     import calendar
      month = sourcedate.month - 1 + months
      year = sourcedate.year + month / 12
      month = month % 12 + 1
@@ -170,18 +185,15 @@ class Monthly(ChecklistItem):
         self.day_of_month = max(int(kw.get('day', 1)), 1)
         self.complete_time = max(int(kw.get('complete_time', 1)) - 1, 0)
 
-    def past_due(self, latest_task):
-        today = get_today()
+    def due_date(self, latest_task):
         due = latest_task.create + timedelta(days=self.complete_time)
         if ((due.month +12) - latest_task.create.month) % 12 >=2:
             due = add_months(latest_task.create, 1)
-        if (today - due).days >= 1:
-            return True
-        else:
-            return False
+        return due
 
-    def schedule_next(self, latest_task):
-        today = get_today()
+    def schedule_next(self, latest_task, today=None):
+        import calendar
+        today = today or get_today()
         last_day_this_month = calendar.monthrange(today.year,today.month)[1]
         sched_day = min(self.day_of_month, last_day_this_month)
         if today.day == sched_day:
@@ -203,15 +215,11 @@ class Floating(ChecklistItem):
         self.complete_time = max(int(kw.get('complete_time', 1)) - 1, 0)
         self.wait = max(int(kw.get("wait", 0)),0)
 
-    def past_due(self, latest_task):
-        today = get_today()
-        due = latest_task.create + timedelta(days=self.complete_time)
-        if (today - due).days >= 1:
-            return True
-        return False
+    def due_date(self, latest_task):
+        return latest_task.create + timedelta(days=self.complete_time)
 
-    def schedule_next(self, latest_task):
-        today = get_today()
+    def schedule_next(self, latest_task, today=None):
+        today = today or get_today()
         if latest_task is None:
             return True
         if (today - latest_task.finish).days >= self.wait:
@@ -225,34 +233,258 @@ class Floating(ChecklistItem):
         res['wait'] = self.wait
         return res
 
+
+class CronSchedule(object):
+    """A compiled cron style day schedule: "day-of-month month day-of-week",
+    or the full five fields with minute and hour ignored. Fields take *,
+    lists, ranges and /steps, month and day names, and L for the last day of
+    the month. Day of week numbers are cron's (0 or 7 is sunday). As in cron,
+    when both day fields are restricted a day matching either one counts."""
+
+    _months = None
+
+    def __init__(self, expr):
+        self.expr = expr
+        fields = expr.split()
+        if len(fields) == 5:
+            fields = fields[2:]
+        if len(fields) != 3:
+            raise ValueError("Schedule %s needs 3 (or 5) fields" % (expr,))
+        dom, month, dow = fields
+
+        self.dom_star = dom == "*"
+        self.last_day = False
+        if "L" in dom.upper().split(","):
+            self.last_day = True
+            dom = ",".join(f for f in dom.split(",") if f.upper() != "L")
+        self.dom_mask = self._parse(dom, 1, 31, self._number) if dom else 0
+        self.month_mask = self._parse(month, 1, 12, self._month)
+        self.dow_star = dow == "*"
+        cron_dows = self._parse(dow, 0, 7, self._weekday)
+        # bit n = python weekday n (monday is 0)
+        self.dow_mask = 0
+        for n in range(8):
+            if cron_dows & (1 << n):
+                self.dow_mask |= 1 << ((n - 1) % 7)
+        # days of a month that match dow_mask, for each weekday the month
+        # can start on (bit d = day d of the month)
+        self._dow_days = []
+        for first in range(7):
+            mask = 0
+            for day in range(1, 32):
+                if self.dow_mask & (1 << ((first + day - 1) % 7)):
+                    mask |= 1 << day
+            self._dow_days.append(mask)
+
+    @staticmethod
+    def _number(word):
+        return int(word)
+
+    @classmethod
+    def _month(cls, word):
+        if cls._months is None:
+            import calendar
+            cls._months = dict((v.lower(), n)
+                    for n, v in enumerate(calendar.month_abbr) if v)
+        try:
+            return int(word)
+        except ValueError:
+            try:
+                return cls._months[word.lower()[:3]]
+            except KeyError:
+                raise ValueError("Month %s not recognized" % (word,))
+
+    @staticmethod
+    def _weekday(word):
+        try:
+            return int(word)
+        except ValueError:
+            # names go through the python numbering (monday is 0)
+            return (parse_day(word) + 1) % 7
+
+    def _parse(self, field, low, high, conv):
+        mask = 0
+        for part in field.split(","):
+            rng, _, step = part.partition("/")
+            step = int(step) if step else 1
+            if rng == "*":
+                start, end = low, high
+            elif "-" in rng:
+                start, end = [conv(x) for x in rng.split("-", 1)]
+            else:
+                start = conv(rng)
+                end = high if step > 1 else start
+            if not (low <= start <= end <= high) or step < 1:
+                raise ValueError("Bad schedule field %s in %s" % (field, self.expr))
+            for n in range(start, end + 1, step):
+                mask |= 1 << n
+        return mask
+
+    def month_days(self, year, month):
+        """Bit mask of the matching days in a month (bit d = day d)"""
+        import calendar
+        if not self.month_mask & (1 << month):
+            return 0
+        first, last = calendar.monthrange(year, month)
+        in_month = (1 << (last + 1)) - 2
+        dom = self.dom_mask
+        if self.last_day:
+            dom |= 1 << last
+        dow = self._dow_days[first]
+        if self.dom_star and self.dow_star:
+            days = in_month
+        elif self.dom_star:
+            days = dow
+        elif self.dow_star:
+            days = dom
+        else:
+            days = dom | dow
+        return days & in_month
+
+    def matches(self, day):
+        return bool(self.month_days(day.year, day.month) & (1 << day.day))
+
+    def next_fire(self, after):
+        """The first matching day after the given one, or None if the
+        schedule never fires"""
+        year, month, start = after.year, after.month, after.day + 1
+        # 8 years covers schedules that only hit feb 29th
+        for _ in range(12 * 8 + 1):
+            days = self.month_days(year, month) >> start << start
+            if days:
+                return date(year, month, (days & -days).bit_length() - 1)
+            year, month, start = year + month // 12, month % 12 + 1, 0
+        return None
+
+
+_schedules = {}
+
+class Cron(ChecklistItem):
+    """Scheduled from a cron style expression (see CronSchedule), so
+    something like every weekday or the 1st and 15th is a single item. A task
+    is due before the next time the schedule fires, or after complete_time
+    days if that is given and sooner."""
+    def __init__(self, **kw):
+        super(Cron, self).__init__(**kw)
+        self.schedule = kw.get('schedule') or '* * *'
+        ct = kw.get('complete_time', None)
+        self.complete_time = max(int(ct) - 1, 0) if ct else None
+        # compiled once per expression, items often share one
+        if self.schedule not in _schedules:
+            _schedules[self.schedule] = CronSchedule(self.schedule)
+        self._sched = _schedules[self.schedule]
+
+    def due_date(self, latest_task):
+        nxt = self._sched.next_fire(latest_task.create)
+        due = nxt - timedelta(days=1) if nxt else None
+        if self.complete_time is not None:
+            ct_due = latest_task.create + timedelta(days=self.complete_time)
+            due = min(due, ct_due) if due else ct_due
+        return due
+
+    def schedule_next(self, latest_task, today=None):
+        return self._sched.matches(today or get_today())
+
+    def toJSON(self):
+        res = super(Cron, self).toJSON()
+        res['type'] = 'cron'
+        res['schedule'] = self.schedule
+        if self.complete_time is not None:
+            res['complete_time'] = self.complete_time + 1
+        return res
+
+
+dispatch = {"floating":Floating,
+            "weekly":Weekly,
+            "monthly": Monthly,
+            "daily":Daily,
+            "cron":Cron
+           }
+
+def make_cl_item(d):
+    """Make a single checklist item object from its json dict"""
+    d = dict(d)
+    t = d.pop('type')
+    t = t.lower()
+    return dispatch[t](**d)
+
 def parse_cl_items(s):
     """Take a json string of checklist items and make a dict of item objects keyed on
     item name (id)"""
-    dispatch = {"floating":Floating,
-                "weekly":Weekly,
-                "monthly": Monthly,
-                "daily":Daily
-               }
-
     if len(s) == 0:
         return []
     raw = json.loads(s)
-    il = []
-    for d in raw:
-        t = d.pop('type')
-        t = t.lower()
-        il.append(dispatch[t](**d))
+    return [make_cl_item(d) for d in raw]
+
+# Batch evaluation: the same decisions ChecklistItem.process makes, with
+# get_today() called once, and the past due check for each item type done
+# over an array of due day ordinals (with numpy when it is installed). The
+# due days come from each item's own due_date, so the date rules live in
+# one place
+
+def _past(dues, today, np):
+    """dues[i] < today for each i, with None never past"""
+    if np is not None and dues:
+        ords = np.array([d if d is not None else today for d in dues])
+        return (ords < today).tolist()
+    return [d is not None and d < today for d in dues]
+
+def _due_ordinal(item, task):
+    due = item.due_date(task)
+    return due.toordinal() if due is not None else None
+
+def process_batch(pairs):
+    """Process (checklist item, latest task) pairs. Gives the same new tasks
+    (in the same order) and status tag updates as calling item.process(task)
+    for each pair"""
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    today = get_today()
+    limit = today.toordinal()
+
+    groups = dict()
+    for n, (item, task) in enumerate(pairs):
+        groups.setdefault(type(item), []).append(n)
+
+    results = [None] * len(pairs)
+    for kind, members in groups.iteritems():
+        # ended tasks (and items with no task yet) skip straight to scheduling
+        active = [n for n in members if pairs[n][1] is not None
+                  and not ChecklistItem.task_ended(pairs[n][1])]
+        past = _past([_due_ordinal(*pairs[n]) for n in active], limit, np)
+        waiting = set()
+        for n, p in zip(active, past):
+            if p:
+                pairs[n][0]._end(pairs[n][1])
+            else:
+                waiting.add(n)
+        for n in members:
+            item, task = pairs[n]
+            if n not in waiting and item.schedule_next(task, today):
+                results[n] = item._new_task()
 
-    return il
+    return [t for t in results if t]
 
-def process_todos(todos, checklist_items):
+def _ended_status(task):
+    if task is None:
+        return ""
+    return task.tags['checklist'].partition('_')[2]
+
+def process_todos(todos, checklist_items, batch=True, stats=None):
     """given a list of all todos for consideration, make new ones as needed,
     properly mark finished and expired items, and generally handle checklist
-    maintenance"""
+    maintenance. batch=False processes the items one at a time. Tasks that
+    get ended are recorded in stats (a ChecklistStats) if given"""
 
-    items = dict()
-    for cli in checklist_items:
-        items[cli.id] = cli
+    # stores hand over their id index directly, so it isn't rebuilt every run
+    if hasattr(checklist_items, 'iteritems'):
+        items = checklist_items
+    else:
+        items = dict()
+        for cli in checklist_items:
+            items[cli.id] = cli
 
 
     task_lists = {k:[] for k in items.keys()}
@@ -265,15 +497,28 @@ def process_todos(todos, checklist_items):
             continue
         task_lists[clid].append(task)
 
-    new_tasks = []
+    pairs = []
     for tid, task_list in task_lists.iteritems():
         task_list.sort(key=attrgetter("create"))
         old_task = None
         if len(task_list):
             old_task = task_list[-1]
-        new_task = items[tid].process(old_task)
-        if new_task:
-            new_tasks.append(new_task)
+        pairs.append((items[tid], old_task))
+
+    before = [_ended_status(task) for item, task in pairs]
+    if batch:
+        new_tasks = process_batch(pairs)
+    else:
+        new_tasks = []
+        for item, old_task in pairs:
+            new_task = item.process(old_task)
+            if new_task:
+                new_tasks.append(new_task)
+
+    if stats is not None:
+        for (item, task), status in zip(pairs, before):
+            if not status and _ended_status(task):
+                stats.record(item.id, task)
     return new_tasks
 
 def serialize_cl_items(items):
@@ -281,132 +526,749 @@ def serialize_cl_items(items):
     of item dicts sutable for saving"""
     return json.dumps([x.toJSON() for x in items], indent=1)
 
-def make_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-f", "--file", default="checklist.json",
-            help="The file containing checklist item configuration")
-    parser.add_argument("-c", "--config_file", default="~/.todo.cfg",
-            help="todo.sh config file to use")
 
-    # sub commands
-    subs = parser.add_subparsers(title="commands", dest="cmd")
-
-    # process
-    proc = subs.add_parser("process", help="Process the checklist according to checklist items")
+class JSONItemStore(object):
+    """Checklist items kept in the classic checklist.json list format. Items
+    are indexed by id in memory, the whole file is rewritten on save"""
+    def __init__(self, filename):
+        self.filename = filename
+        self._items = OrderedDict()
+
+    def open(self):
+        # read on first use - runs that turn out to have nothing to do
+        # never parse the file
+        self._items = None
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = OrderedDict()
+            try:
+                with open(self.filename, 'r') as item_file:
+                    istring = item_file.read().strip()
+            except IOError:
+                istring = ""
+            self.import_json(istring)
+        return self._items
+
+    def import_json(self, s):
+        for item in parse_cl_items(s.strip()):
+            self.add(item)
+
+    def export_json(self):
+        return serialize_cl_items(self)
+
+    def save(self):
+        with open(self.filename, 'w') as item_file:
+            item_file.write(self.export_json())
+
+    def index(self):
+        return self.items
+
+    def get(self, clid):
+        return self.items.get(str(clid))
+
+    def add(self, item):
+        item.id = str(item.id)
+        self.items[item.id] = item
+
+    def remove(self, clid):
+        return self.items.pop(str(clid), None) is not None
+
+    def id_at(self, n):
+        """id of the item at (0 based) position n in the list"""
+        try:
+            return next(islice(self.items, n, None))
+        except StopIteration:
+            return None
+
+    def __contains__(self, clid):
+        return str(clid) in self.items
+
+    def __iter__(self):
+        return self.items.itervalues()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class SQLiteItemStore(object):
+    """Checklist items kept in an sqlite database keyed by id. Every add and
+    remove is committed as it happens, so nothing is rewritten wholesale and
+    concurrent users get sqlite's locking"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = None
+
+    def open(self):
+        import sqlite3
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS items (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT UNIQUE NOT NULL,
+                data TEXT NOT NULL)""")
+        self.db.commit()
+
+    def import_json(self, s):
+        s = s.strip()
+        if not s:
+            return
+        with self.db:
+            for d in json.loads(s):
+                self._put(make_cl_item(d))
+
+    def export_json(self):
+        return serialize_cl_items(self)
+
+    def save(self):
+        self.db.commit()
+
+    def index(self):
+        return OrderedDict((item.id, item) for item in self)
+
+    def _put(self, item):
+        item.id = str(item.id)
+        # keep the position of an item that is being replaced
+        cur = self.db.execute("UPDATE items SET data=? WHERE id=?",
+                (json.dumps(item.toJSON()), item.id))
+        if cur.rowcount == 0:
+            self.db.execute("INSERT INTO items (id, data) VALUES (?, ?)",
+                    (item.id, json.dumps(item.toJSON())))
+
+    def get(self, clid):
+        row = self.db.execute("SELECT data FROM items WHERE id=?",
+                (str(clid),)).fetchone()
+        if row is None:
+            return None
+        return make_cl_item(json.loads(row[0]))
+
+    def add(self, item):
+        with self.db:
+            self._put(item)
+
+    def remove(self, clid):
+        with self.db:
+            cur = self.db.execute("DELETE FROM items WHERE id=?", (str(clid),))
+        return cur.rowcount > 0
+
+    def id_at(self, n):
+        row = self.db.execute("SELECT id FROM items ORDER BY seq LIMIT 1 OFFSET ?",
+                (n,)).fetchone()
+        return row[0] if row else None
+
+    def __contains__(self, clid):
+        return self.db.execute("SELECT 1 FROM items WHERE id=?",
+                (str(clid),)).fetchone() is not None
+
+    def __iter__(self):
+        for row in self.db.execute("SELECT data FROM items ORDER BY seq"):
+            yield make_cl_item(json.loads(row[0]))
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM items").fetchone()[0]
+
+
+def open_item_store(filename):
+    """Open the checklist item store for filename - sqlite for .db/.sqlite
+    files, the json list format for anything else"""
+    if filename.endswith(".db") or filename.endswith(".sqlite"):
+        store = SQLiteItemStore(filename)
+    else:
+        store = JSONItemStore(filename)
+    store.open()
+    return store
+
+DEFAULT_FILE = "checklist.json"
+DEFAULT_CONFIG = "~/.todo.cfg"
+
+# sub command arguments - only the command being run gets built
+
+def _process_args(proc):
     proc.add_argument("-d", "--date", default=None,
             help="process as for the given date instead of today")
+    proc.add_argument("--stream", action="store_true",
+            help="stream todo.txt and done.txt instead of loading them, for very big files")
     proc.set_defaults(func=do_processing)
-    # list
-    ls = subs.add_parser("ls", help="show checklist items")
+
+def _ls_args(ls):
     ls.set_defaults(func=do_list_items)
 
-    # add
-    add = subs.add_parser("add", help="add a checklist item")
-    # TODO: make choices automatic based on globals() and issubclass()
+def _add_args(add):
+    import argparse
     add.add_argument("-t", "--type", help="type of checklistitem",
-            choices=['daily', 'weekly', 'monthly', 'floating'])
+            choices=sorted(dispatch.keys()))
     add.add_argument("--day", help="day to do the argument (not in floating, daily can be a day name)")
     add.add_argument("--complete", '--ct', '--complete_time', dest="complete_time", type=int, default=0,
             help="time to complete this task (not in daily)")
     add.add_argument("--wait", type=int, default=0,
             help="days after completion for new task (float only)")
+    add.add_argument("--schedule",
+            help="cron style 'day-of-month month day-of-week' schedule (cron only)")
     add.add_argument("--id", help="unique id for this task. if not supplied generates uuid")
     add.add_argument("text", nargs=argparse.REMAINDER)
     add.set_defaults(func=do_add_item)
 
-    # remove
-    rm  = subs.add_parser("rm", help="remove a checklist item")
-    rm.add_argument("which", type=int, action='store')
+def _rm_args(rm):
+    rm.add_argument("which", action='store',
+            help="id of the item, or its number in ls")
     rm.set_defaults(func=do_remove_item)
 
+def _import_args(imp):
+    imp.add_argument("source", help="json file to read items from")
+    imp.set_defaults(func=do_import_items)
+
+def _archive_args(arch):
+    arch.set_defaults(func=do_archive)
+
+def _export_args(exp):
+    exp.add_argument("dest", nargs='?', default=None,
+            help="file to write to, stdout if not given")
+    exp.set_defaults(func=do_export_items)
+
+def _stats_args(st):
+    st.add_argument("which", nargs='?', default=None,
+            help="id of the item, or its number in ls (all items if not given)")
+    st.add_argument("--rebuild", action="store_true",
+            help="recount from todo.txt, done.txt and the done archives first")
+    st.set_defaults(func=do_stats)
+
+def _compact_args(comp):
+    comp.add_argument("--days", type=int, default=90,
+            help="only move tasks that ended more than this many days ago (default 90)")
+    comp.add_argument("--to", default=ARCHIVE_FILES[0], choices=ARCHIVE_FILES,
+            help="archive in TODO_DIR to move them to")
+    comp.set_defaults(func=do_compact)
+
+commands = [
+    ("process", "Process the checklist according to checklist items", _process_args),
+    ("ls", "show checklist items", _ls_args),
+    ("add", "add a checklist item", _add_args),
+    ("rm", "remove a checklist item", _rm_args),
+    ("import", "add checklist items from a checklist.json file", _import_args),
+    ("export", "write checklist items in checklist.json format", _export_args),
+    ("archive", "move completed tasks from todo.txt to done.txt", _archive_args),
+    ("stats", "show how checklist items have been getting done", _stats_args),
+    ("compact", "move old ended checklist tasks from done.txt to an archive", _compact_args),
+]
+
+_global_opts = {"-f": "file", "--file": "file",
+                "-c": "config_file", "--config_file": "config_file"}
+
+def _find_cmd(argv):
+    """The sub command named in argv, skipping the values of global options"""
+    names = set(name for name, _, _ in commands)
+    it = iter(argv)
+    for a in it:
+        if a in _global_opts:
+            next(it, None)
+        elif a in names:
+            return a
+    return None
+
+def make_args(argv=None):
+    import argparse
+    cmd = _find_cmd(argv) if argv is not None else None
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--file", default=DEFAULT_FILE,
+            help="The file containing checklist item configuration (.db or .sqlite for an sqlite store)")
+    parser.add_argument("-c", "--config_file", default=DEFAULT_CONFIG,
+            help="todo.sh config file to use")
+
+    # sub commands
+    subs = parser.add_subparsers(title="commands", dest="cmd")
+    for name, helptext, build in commands:
+        sub = subs.add_parser(name, help=helptext)
+        if cmd is None or cmd == name:
+            build(sub)
+
     return parser
 
 
+class _Args(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+def _quick_args(argv):
+    """Handle the common bare invocations (ls and process with only the
+    global options) without loading argparse. Returns None for anything
+    else, which then goes through make_args"""
+    quick = {"ls": dict(func=do_list_items),
+             "process": dict(func=do_processing, date=None, stream=False)}
+    args = dict(file=DEFAULT_FILE, config_file=DEFAULT_CONFIG, cmd=None)
+    it = iter(argv)
+    for a in it:
+        if a in _global_opts:
+            val = next(it, None)
+            if val is None:
+                return None
+            args[_global_opts[a]] = val
+        elif a in quick and args['cmd'] is None:
+            args['cmd'] = a
+        else:
+            return None
+    if args['cmd'] is None:
+        return None
+    args.update(quick[args['cmd']])
+    return _Args(**args)
+
+
 def main():
-    from os.path import join as J, isfile, isdir
+    import sys
+    from os.path import join as J
 
     # handle command line
-    parser = make_args()
-    info = parser.parse_args()
+    argv = sys.argv[1:]
+    info = _quick_args(argv)
+    if info is None:
+        info = make_args(argv).parse_args(argv)
 
     todo.CONFIG_FILE = info.config_file
     tdir = todo.get_todo_env("TODO_DIR")
 
     # get what we need from the todo config file - this allows for consistent handling
 
-    checklist_items = None
-
-    if not isfile(J(tdir, info.file)):
-        with open(J(tdir, info.file), 'w') as item_file:
-            item_file.write("")
+    store = open_item_store(J(tdir, info.file))
 
-    with open(J(tdir, info.file), 'r') as item_file:
-        istring = item_file.read()
-        istring = istring.strip()
-        checklist_items = parse_cl_items(istring)
+    updated = info.func(store, info)
 
-    updated_items = info.func(checklist_items, info)
-
-    if updated_items is None:
+    if updated is None:
         return
 
-    with open(J(tdir, info.file), 'w') as item_file:
-        item_file.write(serialize_cl_items(updated_items))
+    store.save()
 
-def do_add_item(checklist_items, args):
+def do_add_item(store, args):
     # a bit hacky, but since the machinery is in place...
     argdict = vars(args)
     argdict.pop('func')
     argdict['text'] = " ".join(argdict['text'])
-    i = parse_cl_items(json.dumps([argdict]))
-    checklist_items.extend(i)
-    return checklist_items
+    store.add(make_cl_item(argdict))
+    return store
 
-def do_remove_item(checklist_items, args):
-    # human indexing vs real indexing
-    if len(checklist_items) == 0:
+def do_remove_item(store, args):
+    if len(store) == 0:
+        return
+    # ids win, otherwise human indexing vs real indexing
+    clid = args.which
+    if clid not in store:
+        try:
+            clid = store.id_at(int(args.which) - 1)
+        except ValueError:
+            clid = None
+    if clid is None or not store.remove(clid):
+        print("No checklist item %s" % (args.which,))
         return
-    n = args.which - 1
-    del checklist_items[n]
-    return checklist_items
+    return store
+
+def do_import_items(store, args):
+    with open(args.source, 'r') as item_file:
+        store.import_json(item_file.read())
+    return store
 
+def do_archive(store, args):
+    from os.path import join as J
+    tdir = get_todo_env("TODO_DIR")
+    moved = todo.archive(J(tdir, "todo.txt"), J(tdir, "done.txt"))
+    print("Archived %d tasks" % (moved,))
 
-def do_list_items(checklist_items, args):
+def do_compact(store, args):
+    tdir = get_todo_env("TODO_DIR")
+    moved = compact_done(tdir, args.days, args.to)
+    print("Moved %d checklist tasks to %s" % (moved, args.to))
+
+def do_export_items(store, args):
+    if args.dest is None:
+        print(store.export_json())
+        return
+    with open(args.dest, 'w') as item_file:
+        item_file.write(store.export_json())
+
+
+def do_list_items(store, args):
     print("Current checklists:")
 
-    if checklist_items is None or len(checklist_items) == 0:
+    if store is None or len(store) == 0:
         print("No items")
         return
 
-    for n, item in enumerate(checklist_items, 1):
+    for n, item in enumerate(store, 1):
         print ("%3d: %s" %(n, str(item)))
 
-def do_processing(checklist_items, args):
+def _format_stats(item, st):
+    if st is None:
+        return "%s: no ended tasks yet" % (item.id,)
+    line = "%s: %d%% done (%d of %d), streak %d (best %d)" % (item.id,
+            round(st["rate"] * 100), st["complete"],
+            st["complete"] + st["incomplete"], st["streak"], st["best_streak"])
+    if st["average_days"] is not None:
+        line += ", %.1f days to complete" % (st["average_days"],)
+    return line
+
+def do_stats(store, args):
+    from os.path import join as J
+    tdir = get_todo_env("TODO_DIR")
+    stats = ChecklistStats(J(tdir, STATS_FILE))
+    if args.rebuild:
+        tasks = []
+        for name in ("todo.txt", "done.txt"):
+            tf = TodoFile(J(tdir, name))
+            tf.open()
+            tasks.extend(tf.tasks)
+        from todo_archive import BlockArchive
+        for name in ARCHIVE_FILES:
+            if os.path.isfile(J(tdir, name)):
+                archive = BlockArchive(J(tdir, name))
+                archive.open()
+                tasks.extend(archive)
+        stats.rebuild(tasks)
+        stats.save()
+    else:
+        stats.open()
+
+    if store is None or len(store) == 0:
+        print("No items")
+        return
+    if args.which is None:
+        items = list(store)
+    else:
+        # ids win, otherwise human indexing vs real indexing
+        clid = args.which
+        if clid not in store:
+            try:
+                clid = store.id_at(int(args.which) - 1)
+            except ValueError:
+                clid = None
+        if clid is None or clid not in store:
+            print("No checklist item %s" % (args.which,))
+            return
+        items = [store.get(clid)]
+    for item in items:
+        print(_format_stats(item, stats.get(item.id)))
+
+LEDGER_FILE = ".checklist_ledger"
+
+def _file_states(paths):
+    states = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            states.append([path, st.st_mtime, st.st_size])
+        except OSError:
+            states.append([path, None, None])
+    return states
+
+def _ledger_entry(tdir, paths):
+    return {"date": str(get_today()), "files": _file_states(paths)}
+
+def already_processed(tdir, paths):
+    """True when the ledger says processing ran today and none of the files
+    in paths changed since"""
+    try:
+        with open(os.path.join(tdir, LEDGER_FILE), 'r') as fd:
+            ledger = json.load(fd)
+    except (IOError, ValueError):
+        return False
+    return ledger == _ledger_entry(tdir, paths)
+
+def write_ledger(tdir, paths):
+    with open(os.path.join(tdir, LEDGER_FILE), 'w') as fd:
+        json.dump(_ledger_entry(tdir, paths), fd)
+
+STATS_FILE = ".checklist_stats"
+
+class ChecklistStats(object):
+    """Running totals per checklist id of how its tasks ended, kept in
+    STATS_FILE in TODO_DIR and added to as processing ends tasks, so
+    reporting doesn't have to go back through done.txt"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.items = {}
+
+    def open(self):
+        try:
+            with open(self.filename, 'r') as fd:
+                self.items = json.load(fd)
+        except (IOError, ValueError):
+            self.items = {}
+
+    def save(self):
+        tmp = self.filename + ".tmp"
+        with open(tmp, 'w') as fd:
+            json.dump(self.items, fd, sort_keys=True)
+        os.rename(tmp, self.filename)
+
+    def record(self, clid, task):
+        """Count an ended task (checklist:<id>_complete or _incomplete).
+        Tasks should come in the order they ended, for the streaks"""
+        st = self.items.setdefault(clid, {"complete": 0, "incomplete": 0,
+                "streak": 0, "best_streak": 0, "days": 0, "timed": 0,
+                "last": None})
+        if _ended_status(task) == "complete":
+            st["complete"] += 1
+            st["streak"] += 1
+            st["best_streak"] = max(st["best_streak"], st["streak"])
+            if task.create and task.finish:
+                st["days"] += (task.finish - task.create).days
+                st["timed"] += 1
+        else:
+            st["incomplete"] += 1
+            st["streak"] = 0
+        if task.finish:
+            st["last"] = str(task.finish)
+
+    def rebuild(self, tasks):
+        """Start over from the ended checklist tasks in tasks"""
+        self.items = {}
+        ended = [t for t in tasks if 'checklist' in t.tags and _ended_status(t)]
+        ended.sort(key=lambda t: (t.finish or t.create or date.min,
+                                  t.create or date.min))
+        for task in ended:
+            self.record(task.tags['checklist'].partition('_')[0], task)
+
+    def get(self, clid):
+        """Totals for clid, with the completion rate and the average days
+        to complete worked out (None where there is nothing to go on)"""
+        st = self.items.get(clid)
+        if st is None:
+            return None
+        res = dict(st)
+        ended = st["complete"] + st["incomplete"]
+        res["rate"] = float(st["complete"]) / ended if ended else None
+        res["average_days"] = float(st["days"]) / st["timed"] if st["timed"] else None
+        return res
+
+# compressed done.txt history (see todo_archive)
+ARCHIVE_FILES = ("done.txt.gz", "done.txt.bz2")
+
+def archived_latest(archives, todos, items):
+    """Latest archived tasks for the checklist items that have no tasks in
+    todos. Archives hold older history than done.txt, so these are the only
+    ones it can matter for"""
+    missing = set(items.keys())
+    for task in todos:
+        if 'checklist' in task.tags:
+            missing.discard(task.tags['checklist'].partition('_')[0])
+
+    found = []
+    for path in archives:
+        if not missing or not os.path.isfile(path):
+            continue
+        from todo_archive import BlockArchive
+        archive = BlockArchive(path)
+        archive.open()
+        latest = archive.latest_checklist_tasks(missing)
+        found.extend(latest.values())
+        missing.difference_update(latest.keys())
+    return found
+
+def compact_done(tdir, days=90, archive_name=ARCHIVE_FILES[0]):
+    """Move ended checklist tasks from done.txt in tdir that ended more than
+    days ago to the block archive archive_name, keeping the latest task of
+    every checklist id where it is. Processing reads the archives for ids
+    with nothing in done.txt, so nothing it needs goes missing. Returns the
+    number of tasks moved"""
     from os.path import join as J
+    from todo_archive import BlockArchive
 
-    if checklist_items is None:
+    todos = TodoFile(J(tdir, "todo.txt"))
+    todos.open()
+    dones = TodoFile(J(tdir, "done.txt"), merge=True)
+    dones.open()
+
+    # the task process_todos would take as latest for each id
+    latest = {}
+    for task in todos.tasks + dones.tasks:
+        if 'checklist' not in task.tags:
+            continue
+        clid = task.tags['checklist'].partition('_')[0]
+        if clid not in latest or \
+                (task.create or date.min) >= (latest[clid].create or date.min):
+            latest[clid] = task
+
+    cutoff = get_today() - timedelta(days=days)
+    old = []
+    keep = []
+    for task in dones.tasks:
+        if 'checklist' in task.tags and _ended_status(task) and \
+                (task.finish or task.create or cutoff) < cutoff and \
+                latest[task.tags['checklist'].partition('_')[0]] is not task:
+            old.append(task)
+        else:
+            keep.append(task)
+    if not old:
+        return 0
+
+    # archive first - a failure in between leaves copies, not gaps
+    archive = BlockArchive(J(tdir, archive_name))
+    archive.open()
+    archive.append(old)
+    dones.tasks = keep
+    dones.save()
+    return len(old)
+
+def do_processing(store, args):
+    if store is None:
+        return
+    stream = args is not None and args.stream
+    process_dir(store, get_todo_env("TODO_DIR"), stream)
+
+def _latest_in_file(filename, ids, latest):
+    """Update latest (checklist id to (create, filename, line, task)) with
+    the checklist tasks for ids in filename, reading it a line at a time"""
+    try:
+        with todo._locked(filename, False):
+            with open(filename, 'r') as fd:
+                for line in fd:
+                    if "checklist:" not in line:
+                        continue
+                    task = Task.parse(line.strip(), lazy=True)
+                    if task is None or 'checklist' not in task.tags:
+                        continue
+                    clid = task.tags['checklist'].partition('_')[0]
+                    if clid not in ids:
+                        continue
+                    # later wins on equal dates, like the sort in process_todos
+                    create = task.create or date.min
+                    if clid not in latest or create >= latest[clid][0]:
+                        latest[clid] = (create, filename, line.strip(), task)
+    except IOError:
+        pass
+
+def _rewrite_file(filename, changes, new_tasks=()):
+    """Stream filename to a new copy with the lines in changes (old line to
+    new line) replaced - the first line matching each - and new_tasks added
+    at the end, then replace it. Changed lines that are gone (the file
+    changed meanwhile) are added at the end, as a merging save would"""
+    import tempfile
+    changes = dict(changes)
+    with todo._locked(filename, True):
+        try:
+            mode = os.stat(filename).st_mode & 0o7777
+        except OSError:
+            mode = 0o644
+        tmp = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(filename) or ".",
+                prefix=".process", delete=False)
+        try:
+            last = "\n"
+            try:
+                with open(filename, 'r') as fd:
+                    for line in fd:
+                        stripped = line.strip()
+                        if stripped in changes:
+                            line = changes.pop(stripped) + "\n"
+                        tmp.write(line)
+                        last = line
+            except IOError:
+                pass
+            if not last.endswith("\n"):
+                tmp.write("\n")
+            for line in changes.values():
+                tmp.write(line + "\n")
+            for task in new_tasks:
+                tmp.write(str(task) + "\n")
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            tmp.close()
+            os.chmod(tmp.name, mode)
+            os.rename(tmp.name, filename)
+        except:
+            tmp.close()
+            if os.path.exists(tmp.name):
+                os.remove(tmp.name)
+            raise
+
+def _process_streaming(tdir, index, archives, stats, journal):
+    """process_todos over only the latest task of each checklist item, read
+    from todo.txt and done.txt a line at a time, then a second streaming
+    pass over each file to write the changed lines and the new tasks. Peak
+    memory goes with the number of items, not the size of the files"""
+    from os.path import join as J
+    todo_file, done_file = J(tdir, "todo.txt"), J(tdir, "done.txt")
+    latest = {}
+    _latest_in_file(todo_file, index, latest)
+    _latest_in_file(done_file, index, latest)
+
+    tasks = [task for create, name, line, task in latest.itervalues()]
+    # lines aren't always written the way str() writes them, so a task has
+    # changed when str() says so, not when it differs from its line
+    before = dict((id(task), str(task)) for task in tasks)
+    tasks.extend(archived_latest(archives, tasks, index))
+    new_tasks = process_todos(tasks, index, stats=stats)
+
+    changes = {todo_file: {}, done_file: {}}
+    for create, name, line, task in latest.itervalues():
+        if str(task) != before[id(task)]:
+            changes[name][line] = str(task)
+    for name in (todo_file, done_file):
+        if changes[name] or (name == todo_file and new_tasks):
+            _rewrite_file(name, changes[name], new_tasks if name == todo_file else ())
+        if journal is not None:
+            base = os.path.basename(name)
+            for old, new in changes[name].iteritems():
+                op = "complete" if new.startswith("x ") and not old.startswith("x ") \
+                        else "checklist"
+                journal.record(op, base, old=old, new=new)
+    if journal is not None:
+        for task in new_tasks:
+            journal.record("add", "todo.txt", new=str(task))
+
+def process_dir(store, tdir, stream=False):
+    """Process the checklist items in store against the todo files in tdir.
+    stream processes without loading the files (see _process_streaming)"""
+    from os.path import join as J
+
+    archives = [J(tdir, name) for name in ARCHIVE_FILES]
+    inputs = [store.filename, J(tdir, "todo.txt"), J(tdir, "done.txt")] + archives
+    if already_processed(tdir, inputs):
+        return
+
+    if len(store) == 0:
         # nothing todo
         return
 
+    from todo_journal import JOURNAL_FILE
+    journal = None
+    if os.path.isfile(J(tdir, JOURNAL_FILE)):
+        from todo_journal import Journal
+        journal = Journal(J(tdir, JOURNAL_FILE))
+        journal.open()
+
+    stats = ChecklistStats(J(tdir, STATS_FILE))
+    stats.open()
+    index = store.index()
+
+    if stream:
+        _process_streaming(tdir, index, archives, stats, journal)
+        stats.save()
+        write_ledger(tdir, inputs)
+        return
+
     # now for the fun part: open the todo.txt and done.txt files, then
     # combine them into one list for processing. this new list will not reorder
     # the files. Then, add the new items back to todo.txt. Any items marked done
     # by processing will not have been rearranged in order in the files, so when we
     # save each of the files, we have the processing info, and preserved order
 
-    tdir = get_todo_env("TODO_DIR")
-
-
-    todos = TodoFile(J(tdir,"todo.txt"))
+    # todo.sh and others may write while this runs - merge with their
+    # changes rather than overwrite them
+    todos = TodoFile(J(tdir,"todo.txt"), merge=True)
     todos.open()
-    dones = TodoFile(J(tdir, "done.txt"))
+    dones = TodoFile(J(tdir, "done.txt"), merge=True)
     dones.open()
 
+    if journal is not None:
+        journal.track(todos)
+        journal.track(dones)
+
     all_todos = todos.tasks + dones.tasks
-    new_todos = process_todos(all_todos, checklist_items)
+    all_todos.extend(archived_latest(archives, all_todos, index))
+    new_todos = process_todos(all_todos, index, stats=stats)
     todos.tasks.extend(new_todos)
     todos.save()
     dones.save()
+    stats.save()
+    write_ledger(tdir, inputs)
     return
 
 if __name__=='__main__':
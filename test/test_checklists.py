@@ -7,7 +7,7 @@ import json
 from todo import Task, TodoFile
 
 import checklists
-from checklists import ChecklistItem, Daily, Weekly, Monthly, Floating
+from checklists import ChecklistItem, Daily, Weekly, Monthly, Floating, Cron
 from checklists import parse_cl_items, serialize_cl_items, process_todos, parse_day
 
 
@@ -451,3 +451,368 @@ class TestHelpers(TestCase):
         self.assertEqual(parse_day(0),0)
         self.assertEqual(parse_day("0"), 0)
         self.assertEqual(parse_day('wed'), 2)
+
+class TestItemStores(TestCase):
+    def setUp(self):
+        import tempfile
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tdir)
+
+    def check_store(self, fname):
+        store = checklists.open_item_store(os.path.join(self.tdir, fname))
+        self.assertEqual(len(store), 0)
+        store.import_json(fake_tasks)
+        store.add(Daily(id="extra", text="one more"))
+        self.assertTrue("bills" in store)
+        self.assertEqual(store.get("bills").day_of_month, 15)
+        self.assertTrue(store.remove("reports"))
+        self.assertFalse(store.remove("reports"))
+        self.assertEqual(store.id_at(1), "bills")
+        store.save()
+
+        store = checklists.open_item_store(os.path.join(self.tdir, fname))
+        self.assertEqual([i.id for i in store], ["exercise", "bills", "extra"])
+        self.assertEqual(set(store.index().keys()), set(["exercise", "bills", "extra"]))
+        self.assertEqual(json.loads(store.export_json())[1]['id'], "bills")
+        self.assertEqual(store.get("reports"), None)
+
+    def test_json_store(self):
+        """json store keeps order and round trips"""
+        self.check_store("checklist.json")
+        self.assertTrue(isinstance(
+            checklists.open_item_store(os.path.join(self.tdir, "checklist.json")),
+            checklists.JSONItemStore))
+
+    def test_sqlite_store(self):
+        """sqlite store keeps order and round trips"""
+        self.check_store("checklist.db")
+        self.assertTrue(isinstance(
+            checklists.open_item_store(os.path.join(self.tdir, "checklist.db")),
+            checklists.SQLiteItemStore))
+
+    def test_process_with_index(self):
+        """process_todos takes a store index as well as a list"""
+        old_get_today = checklists.get_today
+        checklists.get_today = lambda: date(2013,12,21)
+        try:
+            store = checklists.open_item_store(os.path.join(self.tdir, "checklist.db"))
+            store.import_json(fake_tasks)
+            tasks = [Task.parse(l) for l in fake_todo_file.split("\n") if l]
+            newlist = process_todos(tasks, store.index())
+        finally:
+            checklists.get_today = old_get_today
+        self.assertEqual(set(t.tags['checklist'] for t in newlist),
+                set(['exercise', 'reports']))
+
+class TestArgs(TestCase):
+    def test_quick_args(self):
+        """bare ls/process skip argparse, everything else falls through"""
+        a = checklists._quick_args(["-f", "c.db", "process"])
+        self.assertEqual((a.cmd, a.file, a.date), ("process", "c.db", None))
+        self.assertEqual(a.func, checklists.do_processing)
+        self.assertEqual(checklists._quick_args(["ls"]).func, checklists.do_list_items)
+        self.assertEqual(checklists._quick_args(["process", "-d", "2013-12-21"]), None)
+        self.assertEqual(checklists._quick_args(["rm", "1"]), None)
+        self.assertEqual(checklists._quick_args(["-f"]), None)
+        self.assertEqual(checklists._quick_args([]), None)
+
+    def test_lazy_subcommands(self):
+        """only the command being run needs its arguments"""
+        argv = ["-f", "ls", "rm", "ls"]
+        self.assertEqual(checklists._find_cmd(argv), "rm")
+        a = checklists.make_args(argv).parse_args(argv)
+        self.assertEqual((a.file, a.which), ("ls", "ls"))
+
+class TestProcessing(TestCase):
+    def setUp(self):
+        import tempfile
+        self.tdir = tempfile.mkdtemp()
+        self.cfile = os.path.join(self.tdir, "todo.cfg")
+        with open(self.cfile, 'w') as fd:
+            fd.write("TODO_DIR=%s\n" % (self.tdir,))
+        self.old_config = checklists.todo.CONFIG_FILE
+        checklists.todo.CONFIG_FILE = self.cfile
+        self.old_get_today = checklists.get_today
+        checklists.get_today = lambda: date(2013,12,21)
+        self.todo_file = os.path.join(self.tdir, "todo.txt")
+        with open(self.todo_file, 'w') as fd:
+            fd.write(fake_todo_file)
+        self.item_file = os.path.join(self.tdir, "checklist.json")
+        with open(self.item_file, 'w') as fd:
+            fd.write(fake_tasks)
+
+    def tearDown(self):
+        import shutil
+        checklists.todo.CONFIG_FILE = self.old_config
+        checklists.get_today = self.old_get_today
+        shutil.rmtree(self.tdir)
+
+    def process(self):
+        store = checklists.open_item_store(self.item_file)
+        checklists.do_processing(store, None)
+
+    def todo_lines(self):
+        with open(self.todo_file) as fd:
+            return fd.read().splitlines()
+
+    def test_ledger(self):
+        """processing again on the same day with the same files is a no-op"""
+        opened = []
+        old_open = TodoFile.open
+        def counting_open(tf):
+            opened.append(tf.filename)
+            old_open(tf)
+        TodoFile.open = counting_open
+        try:
+            self.process()
+            self.assertEqual(len(opened), 2)
+            self.assertEqual(len(self.todo_lines()), 7)
+            self.process()
+            self.assertEqual(len(opened), 2)
+
+            # a changed input means processing again
+            os.utime(self.todo_file, (0, 0))
+            self.process()
+            self.assertEqual(len(opened), 4)
+            self.assertEqual(len(self.todo_lines()), 7)
+
+            # and so does a new day
+            checklists.get_today = lambda: date(2013,12,22)
+            self.process()
+            self.assertEqual(len(opened), 6)
+        finally:
+            TodoFile.open = old_open
+
+    def test_journal(self):
+        """processing changes go to the journal when there is one"""
+        from todo_journal import Journal, JOURNAL_FILE
+        open(os.path.join(self.tdir, JOURNAL_FILE), 'w').close()
+        self.process()
+        journal = Journal(os.path.join(self.tdir, JOURNAL_FILE))
+        ops = sorted(e["op"] for e in journal.since(0))
+        self.assertEqual(ops, ["add", "add", "checklist", "complete", "complete"])
+
+    def test_archived_history(self):
+        """items whose history is only in a compressed archive use it"""
+        from todo_archive import BlockArchive
+        archive = BlockArchive(os.path.join(self.tdir, "done.txt.gz"))
+        archive.open()
+        old = Task("pay bills +finances @home", tags={"checklist": "bills_complete"})
+        old.create = date(2013,12,15)
+        old.do()
+        archive.append([old])
+        with open(self.todo_file, 'w') as fd:
+            fd.write("2013-12-21 do something +foo @out checklist:exercise\n")
+            fd.write("2013-12-21 do time sheet +project @work checklist:reports\n")
+        # without the archive bills would get a new task
+        self.process()
+        self.assertEqual(len(self.todo_lines()), 2)
+
+    def test_stream(self):
+        """streaming processing ends up with the same tasks as loading"""
+        done_file = os.path.join(self.tdir, "done.txt")
+        with open(done_file, 'w') as fd:
+            fd.write("x 2013-12-01 2013-11-30 do time sheet +project @work checklist:reports_complete\n")
+            fd.write("x 2013-12-18 something else\n")
+        with open(self.todo_file, 'a') as fd:
+            fd.write("2013-12-19 do something +foo @out checklist:exercise\n")
+
+        def tasks(name):
+            tf = TodoFile(os.path.join(self.tdir, name))
+            tf.open()
+            return [t.content_hash() for t in tf.tasks]
+
+        saved = dict((name, open(os.path.join(self.tdir, name)).read())
+                     for name in ("todo.txt", "done.txt"))
+        self.process()
+        loaded = (tasks("todo.txt"), tasks("done.txt"))
+        for name, contents in saved.iteritems():
+            with open(os.path.join(self.tdir, name), 'w') as fd:
+                fd.write(contents)
+        os.remove(os.path.join(self.tdir, checklists.LEDGER_FILE))
+
+        store = checklists.open_item_store(self.item_file)
+        checklists.process_dir(store, self.tdir, stream=True)
+        self.assertEqual((tasks("todo.txt"), tasks("done.txt")), loaded)
+        # lines processing didn't touch are left as they were
+        self.assertEqual(self.todo_lines()[0], "")
+
+    def test_stream_untouched(self):
+        """streaming leaves an untouched checklist task's line alone, even
+        when str() would write it differently"""
+        from todo_journal import Journal, JOURNAL_FILE
+        open(os.path.join(self.tdir, JOURNAL_FILE), 'w').close()
+        line = "2013-12-21 do  something checklist:exercise zz:1 aa:2"
+        with open(self.todo_file, 'w') as fd:
+            fd.write(line + "\n")
+        store = checklists.open_item_store(self.item_file)
+        checklists.process_dir(store, self.tdir, stream=True)
+        self.assertEqual(self.todo_lines()[0], line)
+        journal = Journal(os.path.join(self.tdir, JOURNAL_FILE))
+        self.assertEqual(set(e["op"] for e in journal.since(0)), set(["add"]))
+
+    def test_compact(self):
+        """old ended checklist tasks move to the archive, latest ones stay"""
+        done_file = os.path.join(self.tdir, "done.txt")
+        with open(done_file, 'w') as fd:
+            fd.write("x 2013-01-02 2013-01-01 do something +foo @out checklist:exercise_complete\n")
+            fd.write("x 2013-01-03 2013-01-02 do something +foo @out checklist:exercise_incomplete\n")
+            fd.write("x 2013-01-03 2013-01-02 unrelated\n")
+            fd.write("x 2013-12-20 2013-12-19 do something +foo @out checklist:exercise_complete\n")
+            fd.write("x 2013-01-20 2013-01-15 pay bills +finances @home checklist:bills_complete\n")
+        with open(self.todo_file, 'w') as fd:
+            fd.write("2013-12-21 do something +foo @out checklist:exercise\n")
+        self.assertEqual(checklists.compact_done(self.tdir, 90), 2)
+        with open(done_file) as fd:
+            lines = fd.read().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].endswith("unrelated"))
+        # the only bills task is its latest, however old
+        self.assertTrue(lines[2].endswith("checklist:bills_complete"))
+
+        from todo_archive import BlockArchive
+        archive = BlockArchive(os.path.join(self.tdir, "done.txt.gz"))
+        archive.open()
+        self.assertEqual([t.tags['checklist'] for t in archive],
+                         ["exercise_complete", "exercise_incomplete"])
+        self.assertEqual(checklists.compact_done(self.tdir, 90), 0)
+
+    def test_stats(self):
+        """processing counts the tasks it ends, and a rebuild agrees"""
+        self.process()
+        stats = checklists.ChecklistStats(
+                os.path.join(self.tdir, checklists.STATS_FILE))
+        stats.open()
+        exercise = stats.get("exercise")
+        self.assertEqual((exercise["complete"], exercise["streak"]), (1, 1))
+        self.assertEqual(exercise["rate"], 1.0)
+        self.assertEqual(exercise["average_days"], 1.0)
+        reports = stats.get("reports")
+        self.assertEqual((reports["incomplete"], reports["streak"]), (1, 0))
+        self.assertEqual(reports["rate"], 0.0)
+        self.assertEqual(reports["average_days"], None)
+        self.assertEqual(stats.get("nothing"), None)
+
+        counted = stats.items
+        tf = TodoFile(self.todo_file)
+        tf.open()
+        stats.rebuild(tf.tasks)
+        self.assertEqual(stats.items, counted)
+
+
+class TestBatch(TestCase):
+    def setUp(self):
+        self.old_get_today = checklists.get_today
+
+    def tearDown(self):
+        checklists.get_today = self.old_get_today
+
+    def make_pairs(self, rnd, today):
+        pairs = []
+        for n in range(200):
+            kind = rnd.choice(["daily", "weekly", "monthly", "floating", "cron"])
+            item = checklists.make_cl_item({"type": kind, "id": "i%d" % n,
+                "text": "item %d" % n, "day": rnd.randint(0, 6) if kind == "weekly"
+                    else rnd.randint(1, 31), "complete_time": rnd.randint(1, 5),
+                "wait": rnd.randint(0, 4), "schedule": "1,15 * *"})
+            task = None
+            if rnd.random() < 0.9:
+                task = Task(item.text, tags={"checklist": item.id})
+                task.create = today - timedelta(days=rnd.randint(0, 40))
+                if rnd.random() < 0.5:
+                    task.do()
+                    task.finish = task.create + timedelta(days=rnd.randint(0, 3))
+                    task.tags["checklist"] += rnd.choice(["", "_complete", "_incomplete"])
+            pairs.append((item, task))
+        return pairs
+
+    def test_batch_matches_items(self):
+        """batch processing gives the same results as item by item"""
+        import copy
+        import random
+        rnd = random.Random(42)
+        for today in (date(2013,12,21), date(2013,2,28), date(2014,1,31)):
+            checklists.get_today = lambda: today
+            pairs = self.make_pairs(rnd, today)
+            copied = copy.deepcopy(pairs)
+            one = [item.process(task) for item, task in pairs]
+            one = [str(t) for t in one if t]
+            batch = [str(t) for t in checklists.process_batch(copied)]
+            self.assertEqual(one, batch)
+            self.assertEqual([str(t) for i, t in pairs], [str(t) for i, t in copied])
+
+    def test_no_history_off_schedule(self):
+        """items with no history that aren't due today make nothing"""
+        checklists.get_today = lambda: date(2013,12,21) # a saturday
+        w = Weekly(id="w", text="weekly", day="mon")
+        self.assertEqual(w.process(None), None)
+        self.assertEqual(checklists.process_batch([(w, None)]), [])
+
+class TestCron(TestCase):
+    def setUp(self):
+        self.old_get_today = checklists.get_today
+        checklists.get_today = lambda: date(2013,12,21) # a saturday
+        self.task = Task(task="a cron task", autodate=False)
+
+    def tearDown(self):
+        checklists.get_today = self.old_get_today
+
+    def test_schedule_parse(self):
+        """cron expressions match the right days"""
+        s = checklists.CronSchedule("* * mon-fri")
+        self.assertTrue(s.matches(date(2013,12,20)))
+        self.assertFalse(s.matches(date(2013,12,21)))
+        s = checklists.CronSchedule("0 9 1,15 * *")
+        self.assertTrue(s.matches(date(2013,12,15)))
+        self.assertFalse(s.matches(date(2013,12,16)))
+        s = checklists.CronSchedule("L 2 *")
+        self.assertTrue(s.matches(date(2012,2,29)))
+        self.assertFalse(s.matches(date(2012,2,28)))
+        # either day field counts when both are given
+        s = checklists.CronSchedule("1 * 0")
+        self.assertTrue(s.matches(date(2013,12,1)))
+        self.assertTrue(s.matches(date(2013,12,22)))
+        self.assertFalse(s.matches(date(2013,12,2)))
+        for bad in ("* *", "32 * *", "* 13 *", "* * 8", "* jun-jan *", "x * *"):
+            self.assertRaises(ValueError, checklists.CronSchedule, bad)
+
+    def test_next_fire(self):
+        """next fire finds the following matching day"""
+        s = checklists.CronSchedule("1,15 * *")
+        self.assertEqual(s.next_fire(date(2013,12,1)), date(2013,12,15))
+        self.assertEqual(s.next_fire(date(2013,12,15)), date(2014,1,1))
+        s = checklists.CronSchedule("29 2 *")
+        self.assertEqual(s.next_fire(date(2013,3,1)), date(2016,2,29))
+        s = checklists.CronSchedule("*/2 * sat,sun")
+        self.assertEqual(s.next_fire(date(2013,12,16)), date(2013,12,17))
+        self.assertEqual(checklists.CronSchedule("31 2 *").next_fire(date(2013,1,1)), None)
+        # agrees with checking day by day
+        s = checklists.CronSchedule("10-20/3 jan,jul-sep 5")
+        day = date(2013,1,1)
+        for n in range(400):
+            nxt = day + timedelta(days=1)
+            while not s.matches(nxt):
+                nxt += timedelta(days=1)
+            self.assertEqual(s.next_fire(day), nxt)
+            day += timedelta(days=1)
+
+    def test_item(self):
+        """cron items schedule on matching days, due before the next one"""
+        c = checklists.make_cl_item({"type": "cron", "id": "c", "text": "t",
+            "schedule": "* * mon,sat"})
+        self.assertTrue(c.schedule_next(None))
+        self.task.create = date(2013,12,16) # monday, due by friday
+        self.assertTrue(c.past_due(self.task))
+        self.task.create = date(2013,12,21)
+        self.assertFalse(c.past_due(self.task))
+        c = Cron(id="c", text="t", schedule="* * mon", complete_time=2)
+        self.assertFalse(c.schedule_next(None))
+        self.task.create = date(2013,12,19)
+        self.assertTrue(c.past_due(self.task))
+        self.task.create = date(2013,12,20)
+        self.assertFalse(c.past_due(self.task))
+        self.assertEqual(parse_cl_items(serialize_cl_items([c]))[0].toJSON(), c.toJSON())
+
@@ -95,6 +95,31 @@ class TestParsing(unittest.TestCase):
         self.assertEqual(set(task.contexts), set(["@context"]))
         self.assertEqual(task.tags, {"tag":"value"})
 
+    def test_lazy(self):
+        """lazy parsing looks the same as eager parsing"""
+        lines = ["(A) 2010-10-01 foo bar +proj1 @context tag:value",
+                 "x 2013-12-15 2013-12-01 foo +proj1 +proj2 a:b c:d",
+                 " 2010-10-2 foo bar +proj1 @context tag:value",
+                 " x foo",
+                 "plain words"]
+        fields = ("done", "priority", "create", "finish", "task", "projects",
+                  "contexts", "tags")
+        for line in lines:
+            eager = Task.parse(line)
+            lazy = Task.parse(line, lazy=True)
+            self.assertEqual(str(lazy), str(eager))
+            for field in fields:
+                self.assertEqual(getattr(Task.parse(line, lazy=True), field),
+                                 getattr(eager, field))
+
+        # setting a field before the rest is decoded keeps the rest
+        task = Task.parse("foo +proj1 tag:value", lazy=True)
+        task.contexts = ["@home"]
+        self.assertEqual(str(task), "foo +proj1 @home tag:value")
+        task = Task.parse("foo +proj1 @home tag:value", lazy=True)
+        task.task = "bar"
+        self.assertEqual(str(task), "bar +proj1 @home tag:value")
+
 class TestOutput(unittest.TestCase):
     def test_basic(self):
         """Simple output test"""
@@ -196,6 +221,19 @@ class TestClass(unittest.TestCase):
         with self.assertRaises(Exception):
             t.priority = 'ABC'
 
+    def test_watch(self):
+        """watchers hear about do and field changes"""
+        t = Task("foo bar")
+        seen = []
+        t.watch(seen.append)
+        t.priority = "a"
+        t.do()
+        t.create = date(2010,1,1)
+        self.assertEqual(len(seen), 4)
+        t.unwatch(seen.append)
+        t.do(False)
+        self.assertEqual(len(seen), 4)
+
     def test_autodate(self):
         """make sure we get a good date"""
         t = Task(autodate=True)
@@ -234,6 +272,376 @@ another task +proj1 @with_context
         f.open()
         self.assertEqual(str(f), self.file_contents)
 
+class TestFileOffsets(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tdir = tempfile.mkdtemp()
+        self.fname = self.tdir + "/todo.txt"
+        with open(self.fname, 'w') as fd:
+            fd.write("first task\n\n(A) second +proj\nthird\n")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tdir)
+
+    def test_offsets(self):
+        """line offsets are tracked on open and save, listeners are told"""
+        f = TodoFile(self.fname)
+        f.open()
+        self.assertEqual(f.offsets, [0, 12, 29])
+        saved = []
+        f.listeners.append(saved.append)
+        del f.tasks[0]
+        f.save()
+        self.assertEqual(f.offsets, [0, 17])
+        self.assertEqual(saved, [f])
+        with open(self.fname) as fd:
+            self.assertEqual(fd.read(), "(A) second +proj\nthird\n")
+
+class TestMergeOnSave(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tdir = tempfile.mkdtemp()
+        self.fname = self.tdir + "/todo.txt"
+        with open(self.fname, 'w') as fd:
+            fd.write("first task\nsecond task\nthird task\nfourth task\n")
+        self.mine = TodoFile(self.fname, merge=True)
+        self.mine.open()
+        self.theirs = TodoFile(self.fname)
+        self.theirs.open()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tdir)
+
+    def lines(self):
+        with open(self.fname) as fd:
+            return fd.read().splitlines()
+
+    def test_merge(self):
+        """changes made on disk since open survive a merging save"""
+        self.theirs.tasks[3].task = "fourth task, edited"
+        self.theirs.tasks.append(Task("theirs"))
+        self.theirs.save()
+        self.mine.tasks[0].do()
+        del self.mine.tasks[1]
+        self.mine.tasks.append(Task("mine"))
+        self.mine.save()
+        self.assertEqual(self.lines(), ["x %s first task" % (date.today(),),
+            "third task", "fourth task, edited", "theirs", "mine"])
+        self.assertEqual(self.mine.offsets[1], len(self.lines()[0]) + 1)
+
+    def test_conflict(self):
+        """a task changed on both sides keeps both versions"""
+        del self.theirs.tasks[0]
+        self.theirs.tasks[0].task = "second, their way"
+        self.theirs.save()
+        self.mine.tasks[0].task = "first, my way"
+        self.mine.tasks[1].task = "second, my way"
+        self.mine.save()
+        self.assertEqual(self.lines(), ["second, their way", "third task",
+            "fourth task", "first, my way", "second, my way"])
+
+    def test_no_merge(self):
+        """without merging, the last save wins as before"""
+        self.theirs.tasks.append(Task("theirs"))
+        self.theirs.save()
+        self.mine.save(merge=False)
+        self.assertEqual(len(self.lines()), 4)
+
+class TestContentHash(unittest.TestCase):
+    def test_hash(self):
+        """hashes ignore tag order and follow changes"""
+        a = Task.parse("(A) 2010-10-01 foo +p @c due:2010-10-05 t:2010-10-02")
+        b = Task.parse("(A) 2010-10-01 foo @c t:2010-10-02 +p due:2010-10-05")
+        self.assertEqual(a.content_hash(), b.content_hash())
+        b.tags['due'] = '2010-10-06'
+        b.changed()
+        self.assertNotEqual(a.content_hash(), b.content_hash())
+        h = a.content_hash()
+        a.do()
+        self.assertNotEqual(a.content_hash(), h)
+        h = a.content_hash()
+        a.task = "bar"
+        self.assertNotEqual(a.content_hash(), h)
+
+    def test_set_ops(self):
+        mine = TodoFile()
+        mine.tasks = [Task.parse(l) for l in ["a +p", "b", "c", "a +p"]]
+        theirs = TodoFile()
+        theirs.tasks = [Task.parse(l) for l in ["d", "a +p", "b"]]
+        self.assertEqual([str(t) for t in mine.union(theirs)],
+                         ["a +p", "b", "c", "a +p", "d"])
+        self.assertEqual([str(t) for t in mine.difference(theirs)], ["c"])
+        self.assertEqual([[str(t) for t in g] for g in mine.duplicates()],
+                         [["a +p", "a +p"]])
+        self.assertEqual([(op, n, str(t)) for op, n, t in mine.edit_script(theirs)],
+                         [("delete", 2, "c"), ("delete", 3, "a +p"), ("add", 0, "d")])
+
+class TestFilter(unittest.TestCase):
+    lines = ["(A) 2020-01-02 foo +p @c due:2020-02-01\n",
+             "x 2020-01-05 2020-01-01 bar +q\n",
+             "\n",
+             "(B) baz +p k:v"]
+
+    def run_filter(self, argv):
+        args = todo.make_filter_args().parse_args(argv)
+        return list(todo.filter_lines(self.lines, args))
+
+    def test_filters(self):
+        self.assertEqual(self.run_filter(["--project", "p"]),
+                         [self.lines[0], "(B) baz +p k:v\n"])
+        self.assertEqual(self.run_filter(["--done"]), [self.lines[1]])
+        self.assertEqual(self.run_filter(["-p", "b-"]),
+                         [self.lines[1], "(B) baz +p k:v\n"])
+        self.assertEqual(self.run_filter(["--tag", "k=v"]), ["(B) baz +p k:v\n"])
+        self.assertEqual(self.run_filter(["--tag", "k=w"]), [])
+        self.assertEqual(self.run_filter(["--created-from", "2020-01-02"]),
+                         [self.lines[0]])
+        self.assertEqual(self.run_filter(["--finished-to", "2020-01-05"]),
+                         [self.lines[1]])
+
+    def test_rewrite(self):
+        out = self.run_filter(["--all", "--open", "--project", "+p",
+                               "--set-priority", "-", "--del-tag", "due",
+                               "--add-context", "home"])
+        self.assertEqual(out, ["2020-01-02 foo +p @c @home\n", self.lines[1],
+                               "\n", "baz +p @home k:v\n"])
+
+class TestConvert(unittest.TestCase):
+    text = ("(A) 2020-01-02 foo, \"quoted\" +p @c due:2020-02-01\n"
+            "x 2020-01-05 2020-01-01 bar +q +r\n"
+            "\n"
+            "caf\xc3\xa9 k:v\n")
+
+    def roundtrip(self, fmt):
+        from StringIO import StringIO
+        converted = StringIO()
+        todo.convert(StringIO(self.text), converted, "todo", fmt)
+        back = StringIO()
+        todo.convert(StringIO(converted.getvalue()), back, fmt, "todo")
+        return converted.getvalue(), back.getvalue()
+
+    def hashes(self, text):
+        return [t.content_hash() for t in todo.todo_to_tasks(text.splitlines())]
+
+    def test_jsonl(self):
+        converted, back = self.roundtrip("jsonl")
+        self.assertEqual(len(converted.splitlines()), 3)
+        self.assertEqual(self.hashes(back), self.hashes(self.text))
+        self.assertTrue(isinstance(back, str))
+
+    def test_csv(self):
+        converted, back = self.roundtrip("csv")
+        self.assertEqual(converted.splitlines()[0],
+                         "done,priority,create,finish,task,projects,contexts,tags")
+        self.assertEqual(self.hashes(back), self.hashes(self.text))
+
+class TestRefresh(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tdir = tempfile.mkdtemp()
+        self.done = self.tdir + "/done.txt"
+        with open(self.done, 'w') as fd:
+            fd.write("x 2013-12-01 one\nx 2013-12-02 two\n")
+        self.tf = TodoFile(self.done)
+        self.tf.open()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tdir)
+
+    def append(self, text):
+        with open(self.done, 'a') as fd:
+            fd.write(text)
+
+    def test_appended(self):
+        """appended lines are read on their own"""
+        first = self.tf.tasks[0]
+        self.assertEqual(self.tf.refresh(), 0)
+        self.append("x 2013-12-03 three\n\nx 2013-12-04 four\n")
+        self.assertEqual(self.tf.refresh(), 2)
+        self.assertTrue(self.tf.tasks[0] is first)
+        self.assertEqual([t.task for t in self.tf.tasks], ["one", "two", "three", "four"])
+        with open(self.done) as fd:
+            fd.seek(self.tf.offsets[3])
+            self.assertEqual(fd.readline(), "x 2013-12-04 four\n")
+        # and again, after a save
+        self.tf.save()
+        self.append("x 2013-12-05 five\n")
+        self.assertEqual(self.tf.refresh(), 1)
+        self.assertTrue(self.tf.tasks[0] is first)
+
+    def test_rewritten(self):
+        """anything but an append reloads"""
+        first = self.tf.tasks[0]
+        with open(self.done, 'w') as fd:
+            fd.write("x 2013-12-01 one\nx 2013-12-02 TWO\nx 2013-12-03 three\n")
+        self.assertEqual(self.tf.refresh(), 3)
+        self.assertFalse(self.tf.tasks[0] is first)
+        self.assertEqual(self.tf.tasks[1].task, "TWO")
+
+        with open(self.done, 'w') as fd:
+            fd.write("x 2013-12-01 one\n")
+        self.assertEqual(self.tf.refresh(), 1)
+        self.assertEqual(len(self.tf.tasks), 1)
+
+    def test_no_lock(self):
+        """files are still read where the lock file can't be made"""
+        import os, errno
+        real_open = os.open
+        def no_locks(name, *args):
+            if name.endswith(".lock"):
+                raise OSError(errno.EACCES, "Permission denied", name)
+            return real_open(name, *args)
+        os.open = no_locks
+        try:
+            tf = TodoFile(self.done)
+            tf.open()
+            self.assertEqual(len(tf.tasks), 2)
+            self.append("x 2013-12-03 three\n")
+            self.assertEqual(tf.refresh(), 1)
+        finally:
+            os.open = real_open
+        # a missing file is still just empty
+        tf = TodoFile(self.tdir + "/missing.txt")
+        tf.open()
+        self.assertEqual(tf.tasks, [])
+
+    def test_no_dir(self):
+        """a file in a missing directory, or with no name, is empty and
+        leaves no lock file behind"""
+        import os
+        tf = TodoFile(self.tdir + "/missing/todo.txt")
+        tf.open()
+        self.assertEqual(tf.tasks, [])
+        self.assertEqual(tf.refresh(), 0)
+        cwd = os.getcwd()
+        os.chdir(self.tdir)
+        try:
+            tf = TodoFile()
+            tf.open()
+            self.assertEqual(tf.tasks, [])
+            self.assertFalse(os.path.exists(".lock"))
+        finally:
+            os.chdir(cwd)
+
+class TestBulkEdit(unittest.TestCase):
+    contents = "(A) call mom +family\n\nfix  sink   +house\npaint fence +house k:v\n"
+
+    def setUp(self):
+        import tempfile
+        self.tdir = tempfile.mkdtemp()
+        self.todo = self.tdir + "/todo.txt"
+        with open(self.todo, 'w') as fd:
+            fd.write(self.contents)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tdir)
+
+    def read(self):
+        with open(self.todo) as fd:
+            return fd.read()
+
+    def test_unopened(self):
+        """only matching lines are rewritten"""
+        tf = TodoFile(self.todo)
+        house = lambda task: "+house" in task.projects
+        def tag(task):
+            task.tags["room"] = "yard"
+        self.assertEqual(tf.update_where(lambda t: "k" in t.tags, tag,
+                                         priority="b"), 1)
+        self.assertEqual(self.read(), "(A) call mom +family\n\nfix  sink   +house\n"
+                         "(B) paint fence +house k:v room:yard\n")
+        self.assertEqual(tf.update_where(lambda t: False, priority="c"), 0)
+        self.assertEqual(tf.complete_where(house), 2)
+        self.assertEqual(tf.complete_where(house), 0)
+        self.assertEqual(tf.delete_where(lambda t: t.done), 2)
+        self.assertEqual(self.read(), "(A) call mom +family\n\n")
+
+    def test_opened(self):
+        """an open TodoFile is edited in place and stays in step"""
+        tf = TodoFile(self.todo)
+        tf.open()
+        saved = []
+        tf.listeners.append(saved.append)
+        first = tf.tasks[0]
+        self.assertEqual(tf.delete_where(lambda t: "fence" in t.task), 1)
+        self.assertEqual(len(tf.tasks), 2)
+        self.assertTrue(tf.tasks[0] is first)
+        self.assertEqual(tf.update_where(lambda t: t.priority == "(A)", priority=""), 1)
+        self.assertEqual(first.priority, "")
+        self.assertEqual(saved, [tf, tf])
+        with open(self.todo) as fd:
+            for task, offset in zip(tf.tasks, tf.offsets):
+                fd.seek(offset)
+                self.assertEqual(Task.parse(fd.readline().strip()).task, task.task)
+
+    def test_unsaved(self):
+        """a TodoFile with unsaved changes is left alone, and the file is
+        edited from its own lines"""
+        tf = TodoFile(self.todo)
+        tf.open()
+        tf.tasks.sort(key=lambda t: t.task, reverse=True)
+        self.assertEqual(tf.complete_where(lambda t: "mom" in t.task), 1)
+        self.assertEqual(self.read().splitlines()[0], "x %s call mom +family" %
+                         date.today())
+        self.assertEqual(self.read().splitlines()[2:],
+                         ["fix  sink   +house", "paint fence +house k:v"])
+        self.assertFalse(any(t.done for t in tf.tasks))
+
+        tf = TodoFile(self.todo)
+        tf.open()
+        del tf.tasks[0]
+        tf.tasks.append(Task("new one"))
+        self.assertEqual(tf.delete_where(lambda t: "fence" in t.task), 1)
+        self.assertEqual([t.task for t in tf.tasks], ["fix sink", "paint fence", "new one"])
+        self.assertEqual(self.read().splitlines()[2:], ["fix  sink   +house"])
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tdir = tempfile.mkdtemp()
+        self.todo = self.tdir + "/todo.txt"
+        self.done = self.tdir + "/done.txt"
+        with open(self.todo, 'w') as fd:
+            fd.write("open one\nx 2013-12-20 done one\n\n(A) open two\nx done two")
+        with open(self.done, 'w') as fd:
+            fd.write("x 2013-12-01 old")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tdir)
+
+    def read(self, fname):
+        with open(fname) as fd:
+            return fd.read()
+
+    def test_archive(self):
+        """completed tasks move to done.txt, the rest stay as they were"""
+        self.assertEqual(todo.archive(self.todo, self.done, bufsize=10), 2)
+        self.assertEqual(self.read(self.todo), "open one\n\n(A) open two\n")
+        self.assertEqual(self.read(self.done),
+                "x 2013-12-01 old\nx 2013-12-20 done one\nx done two\n")
+        # nothing left to move leaves both alone
+        self.assertEqual(todo.archive(self.todo, self.done), 0)
+        self.assertEqual(self.read(self.todo), "open one\n\n(A) open two\n")
+
+    def test_archive_failure(self):
+        """a failed archive leaves both files as they were"""
+        import os
+        old_rename = os.rename
+        def bad_rename(*args):
+            raise OSError("no")
+        os.rename = bad_rename
+        try:
+            self.assertRaises(OSError, todo.archive, self.todo, self.done)
+        finally:
+            os.rename = old_rename
+        self.assertEqual(self.read(self.done), "x 2013-12-01 old")
+        self.assertEqual(len(os.listdir(self.tdir)), 4)
+
 class TestFile(unittest.TestCase):
     def setUp(self):
         import os
@@ -259,4 +667,17 @@ class TestFile(unittest.TestCase):
         res = todo.get_todo_env("TODO_DIR")
         self.assertEqual(res, self.todir)
 
+    def test_env_from_todo_sh(self):
+        """settings exported by todo.sh are used for its config"""
+        import os
+        os.environ["TODOTXT_CFG_FILE"] = self.cfile
+        os.environ["TODO_DIR"] = "/somewhere/else"
+        try:
+            self.assertEqual(todo.get_todo_env("TODO_DIR"), "/somewhere/else")
+            os.environ["TODOTXT_CFG_FILE"] = "/nonexistent.cfg"
+            self.assertEqual(todo.get_todo_env("TODO_DIR"), self.todir)
+        finally:
+            del os.environ["TODOTXT_CFG_FILE"]
+            del os.environ["TODO_DIR"]
+
 
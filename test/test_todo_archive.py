@@ -0,0 +1,74 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from datetime import date, timedelta
+
+from todo import Task
+from todo_archive import BlockArchive
+
+def make_tasks(n):
+    tasks = []
+    start = date(2013,1,1)
+    for i in range(n):
+        t = Task("task %d" % i, tags={"checklist": "item%d_complete" % (i % 3)})
+        t.create = start + timedelta(days=i)
+        t.done = True
+        t.finish = start + timedelta(days=i)
+        tasks.append(t)
+    return tasks
+
+class TestBlockArchive(unittest.TestCase):
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def check(self, name):
+        fname = os.path.join(self.tdir, name)
+        tasks = make_tasks(100)
+        a = BlockArchive(fname, block_lines=10)
+        a.open()
+        a.append(tasks[:55])
+        a.append(tasks[55:])
+        self.assertEqual(len(a.blocks), 11)
+        self.assertEqual([str(t) for t in a], [str(t) for t in tasks])
+
+        # range queries only read the blocks they need
+        read = []
+        old_read = a.read_block
+        a.read_block = lambda n: read.append(n) or old_read(n)
+        found = list(a.tasks_between(date(2013,1,12), date(2013,1,14)))
+        self.assertEqual([t.task for t in found], ["task 11", "task 12", "task 13"])
+        self.assertEqual(read, [1])
+
+        latest = a.latest_checklist_tasks()
+        self.assertEqual(sorted(t.task for t in latest.values()),
+                ["task 97", "task 98", "task 99"])
+        self.assertEqual(read, [1, 10])
+        return fname
+
+    def test_gzip(self):
+        """gzip archives read back by block and as a whole"""
+        fname = self.check("done.txt.gz")
+        with gzip.open(fname) as fd:
+            self.assertEqual(len(fd.read().splitlines()), 100)
+
+    def test_bz2(self):
+        """bz2 archives read back by block"""
+        self.check("done.txt.bz2")
+
+    def test_rebuild_index(self):
+        """a lost index is rebuilt from the archive"""
+        for name in ("done.txt.gz", "done.txt.bz2"):
+            fname = os.path.join(self.tdir, name)
+            a = BlockArchive(fname, block_lines=7)
+            a.open()
+            a.append(make_tasks(30))
+            os.remove(fname + ".idx")
+            b = BlockArchive(fname)
+            b.open()
+            self.assertEqual(b.blocks, a.blocks)
+            self.assertEqual(len(b), 30)
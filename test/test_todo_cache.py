@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from todo import Task, TodoFile
+from todo_cache import TaskCache
+
+todo_contents = """(A) 2013-12-01 call mom @phone
+x 2013-12-03 2013-12-02 pay rent +home +bills due:2013-12-05 t:2013-12-01
+plain task
+"""
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.todo_file = os.path.join(self.tdir, "todo.txt")
+        with open(self.todo_file, 'w') as fd:
+            fd.write(todo_contents)
+        self.cache = TaskCache(self.tdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def test_publish_open(self):
+        self.assertEqual(self.cache.open(self.todo_file), None)
+        self.assertTrue(self.cache.publish(self.todo_file))
+        self.assertFalse(self.cache.publish(self.todo_file))
+
+        cached = self.cache.open(self.todo_file)
+        self.assertEqual(len(cached), 3)
+        self.assertEqual([str(t) for t in cached], todo_contents.splitlines())
+        self.assertEqual(cached[-1].task, "plain task")
+        self.assertEqual(cached[1].tags, {"due": "2013-12-05", "t": "2013-12-01"})
+        cached.close()
+
+    def test_stale(self):
+        """a changed file isn't served from the cache until republished"""
+        self.cache.publish(self.todo_file)
+        with open(self.todo_file, 'a') as fd:
+            fd.write("another\n")
+        self.assertEqual(self.cache.open(self.todo_file), None)
+        self.assertEqual(len(self.cache.tasks(self.todo_file)), 4)
+        self.assertTrue(self.cache.publish(self.todo_file))
+        self.assertEqual(str(self.cache.tasks(self.todo_file)[-1]), "another")
+
+    def test_attach(self):
+        tf = TodoFile(self.todo_file)
+        tf.open()
+        self.cache.attach(tf)
+        tf.tasks.append(Task("new one", contexts=["@home"]))
+        tf.save()
+        cached = self.cache.open(self.todo_file)
+        self.assertEqual(str(cached[3]), "new one @home")
+        cached.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+from todo import Task, TodoFile
+from todo_db import TodoDB
+
+todo_contents = """(A) 2010-10-01 foo bar baz +proj1
+another task +proj1 @with_context
+
+2010-10-02 do a thing +proj2 due:2010-10-05
+"""
+
+class TestTodoDB(unittest.TestCase):
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tdir, "todo.txt")
+        with open(self.fname, 'w') as fd:
+            fd.write(todo_contents)
+        self.db = TodoDB(os.path.join(self.tdir, "todo.db"))
+        self.db.open()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tdir)
+
+    def test_sync_and_query(self):
+        """tasks are mirrored with their fields"""
+        self.assertEqual(self.db.sync(self.fname), 3)
+        self.assertEqual(self.db.sync(self.fname), 0)
+        found = [t.task for tid, t in self.db.with_project("+proj1")]
+        self.assertEqual(found, ["foo bar baz", "another task"])
+        found = [t.task for tid, t in self.db.with_tag("due", "2010-10-05")]
+        self.assertEqual(found, ["do a thing"])
+        found = [t.task for tid, t in self.db.tasks("priority=?", ("A",))]
+        self.assertEqual(found, ["foo bar baz"])
+        found = [t.task for tid, t in self.db.tasks("created >= ?", ("2010-10-02",))]
+        self.assertEqual(found, ["do a thing"])
+
+    def test_incremental(self):
+        """appends are read on their own, rewrites reload"""
+        self.db.sync(self.fname)
+        with open(self.fname, 'a') as fd:
+            fd.write("appended @home\n")
+        self.assertEqual(self.db.sync(self.fname), 1)
+        self.assertEqual(len(list(self.db.tasks())), 4)
+        with open(self.fname, 'w') as fd:
+            fd.write("just one\n")
+        self.assertEqual(self.db.sync(self.fname), 1)
+        self.assertEqual([t.task for tid, t in self.db.tasks()], ["just one"])
+        # an edit that keeps the size (and the last line) is a rewrite too
+        with open(self.fname, 'w') as fd:
+            fd.write("edit a:1\njust one\n")
+        self.db.sync(self.fname)
+        with open(self.fname, 'w') as fd:
+            fd.write("edit t:2\njust one\n")
+        st = os.stat(self.fname)
+        os.utime(self.fname, (st.st_atime, st.st_mtime + 1))
+        self.assertEqual(self.db.sync(self.fname), 2)
+        self.assertEqual([t.task for tid, t in self.db.with_tag("t", "2")], ["edit"])
+
+    def test_write_back(self):
+        """changes go to the text file"""
+        self.db.sync(self.fname)
+        tid, task = list(self.db.with_context("@with_context"))[0]
+        task.do()
+        self.db.update(tid, task)
+        self.db.add(self.fname, Task("new one"))
+        tf = TodoFile(self.fname)
+        tf.open()
+        self.assertTrue(tf.tasks[1].done)
+        self.assertEqual(tf.tasks[-1].task, "new one")
+        self.assertEqual(len(list(self.db.tasks("done=1"))), 1)
+        tid, task = list(self.db.tasks("text=?", ("new one",)))[0]
+        self.db.delete(tid)
+        tf.open()
+        self.assertEqual(len(tf.tasks), 3)
+
+    def test_stale_write(self):
+        """writes to a task that changed on disk are refused"""
+        self.db.sync(self.fname)
+        tid, task = list(self.db.tasks())[0]
+        with open(self.fname, 'w') as fd:
+            fd.write("something else\n")
+        with self.assertRaises(ValueError):
+            self.db.update(tid, task)
@@ -0,0 +1,164 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+from todo import Task, TodoFile
+from todo_index import TagIndex, PriorityIndex
+
+todo_contents = """2013-12-01 pay rent due:2013-12-20
+no due date at all +proj
+(A) call mom due:2013-12-18 t:2013-12-10
+fuzzy one due:someday
+water plants due:2013-12-25 n:3
+"""
+
+class TestTagIndex(unittest.TestCase):
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tdir, "todo.txt")
+        with open(self.fname, 'w') as fd:
+            fd.write(todo_contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def open_index(self):
+        idx = TagIndex(self.fname, {"due": "date", "t": "date", "n": "int"})
+        idx.open()
+        return idx
+
+    def test_range(self):
+        """range queries give the matching lines in value order"""
+        idx = self.open_index()
+        found = idx.tasks_between("due", date(2013,12,18), "2013-12-20")
+        self.assertEqual([t.task for t in found], ["call mom", "pay rent"])
+        self.assertEqual(len(idx.offsets_between("due")), 3)
+        self.assertEqual(len(idx.offsets_between("due", low=date(2013,12,19))), 2)
+        self.assertEqual([t.task for t in idx.tasks_between("n", 1, 5)], ["water plants"])
+        self.assertEqual(idx.offsets_between("t", high="2013-12-01"), [])
+
+    def test_persist_and_append(self):
+        """the index is reused, and appends are picked up"""
+        self.open_index()
+        with open(self.fname, 'a') as fd:
+            fd.write("later due:2013-12-19\n")
+        idx = self.open_index()
+        found = idx.tasks_between("due", "2013-12-18", "2013-12-20")
+        self.assertEqual([t.task for t in found], ["call mom", "later", "pay rent"])
+        with open(self.fname, 'w') as fd:
+            fd.write("only one due:2014-01-01\n")
+        idx = self.open_index()
+        self.assertEqual([t.task for t in idx.tasks_between("due")], ["only one"])
+
+    def test_todofile_saves(self):
+        """attached indexes follow TodoFile saves"""
+        idx = self.open_index()
+        tf = TodoFile(self.fname)
+        tf.open()
+        idx.attach(tf)
+        del tf.tasks[0]
+        tf.tasks.append(Task("new", tags={"due": "2013-12-21"}))
+        tf.save()
+        found = idx.tasks_between("due", "2013-12-18", "2013-12-21")
+        self.assertEqual([t.task for t in found], ["call mom", "new"])
+        # and what was saved is what gets loaded
+        self.assertEqual(self.open_index().offsets, idx.offsets)
+
+    def test_same_size_rewrite(self):
+        """a rewrite that keeps the size isn't taken for an append"""
+        self.open_index()
+        with open(self.fname, 'w') as fd:
+            fd.write(todo_contents.replace("2013-12-20", "2013-12-02"))
+        idx = self.open_index()
+        self.assertEqual(idx.tasks_between("due", high="2013-12-10")[0].task, "pay rent")
+
+    def test_incremental_update(self):
+        """a save that changes one line only reindexes that line"""
+        idx = self.open_index()
+        tf = TodoFile(self.fname)
+        tf.open()
+        idx.attach(tf)
+        rebuilds = []
+        idx._rebuild = rebuilds.append
+        tf.tasks[-1].tags["due"] = "2013-12-01"
+        tf.tasks[-1].tags["n"] = "4"
+        tf.save()
+        self.assertEqual(rebuilds, [])
+        found = idx.tasks_between("due", high="2013-12-18")
+        self.assertEqual([t.task for t in found], ["water plants", "call mom"])
+        self.assertEqual(len(idx.offsets_between("due")), 3)
+        self.assertEqual(self.open_index().values, idx.values)
+
+prio_contents = """(B) 2013-12-05 second b
+(A) 2013-12-10 newer a
+no priority
+x 2013-12-11 (A) 2013-12-01 done already
+(B) 2013-12-01 first b
+(A) 2013-12-02 older a
+"""
+
+class TestPriorityIndex(unittest.TestCase):
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tdir, "todo.txt")
+        with open(self.fname, 'w') as fd:
+            fd.write(prio_contents)
+        self.tf = TodoFile(self.fname)
+        self.tf.open()
+        self.index = PriorityIndex(self.tf)
+        self.index.build()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def top(self, k):
+        return [t.task for t in self.index.top(k)]
+
+    def test_top(self):
+        """top k by priority then age"""
+        self.assertEqual(self.top(3), ["older a", "newer a", "first b"])
+        self.assertEqual(self.top(10),
+                ["older a", "newer a", "first b", "second b", "no priority"])
+        self.assertEqual(len(self.index), 5)
+
+    def test_changes(self):
+        """done, reprioritized, added and removed tasks are followed"""
+        self.tf.tasks[5].do()
+        self.tf.tasks[2].priority = "A"
+        self.assertEqual(self.top(2), ["newer a", "no priority"])
+        self.tf.tasks[2].priority = "C"
+        new = Task("brand new")
+        new.priority = "A"
+        self.index.add(new)
+        self.index.discard(self.tf.tasks[1])
+        self.assertEqual(self.top(4), ["brand new", "first b", "second b", "no priority"])
+        self.assertEqual(self.top(1), ["brand new"])
+        # undone tasks come back
+        self.tf.tasks[5].do(False)
+        self.assertEqual(self.top(2), ["older a", "brand new"])
+
+    def test_persist(self):
+        """saved order answers from an unchanged file"""
+        self.index.keep = 2
+        self.index.attach(self.tf)
+        builds = []
+        self.index.build = lambda: builds.append(True)
+        self.tf.tasks[0].priority = "A"
+        del self.tf.tasks[1]
+        self.tf.tasks.append(Task("later"))
+        self.tf.save()
+        self.assertEqual(builds, [])
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.top(5), ["older a", "second b", "first b", "no priority",
+                                       "later"])
+        found = PriorityIndex.top_from_file(self.fname, 2)
+        self.assertEqual([t.task for t in found], ["older a", "second b"])
+        # more than was saved means loading the file
+        found = PriorityIndex.top_from_file(self.fname, 3)
+        self.assertEqual([t.task for t in found], ["older a", "second b", "first b"])
+        with open(self.fname, 'a') as fd:
+            fd.write("(A) 2013-11-01 appended\n")
+        found = PriorityIndex.top_from_file(self.fname, 1)
+        self.assertEqual([t.task for t in found], ["appended"])
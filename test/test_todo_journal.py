@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+from todo import Task, TodoFile
+from todo_journal import Journal, apply_entries, sync
+
+todo_contents = """(A) call mom
+pay rent +home
+water plants checklist:plants
+"""
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        for side in ("core", "tablet"):
+            os.makedirs(os.path.join(self.tdir, side))
+            with open(os.path.join(self.tdir, side, "todo.txt"), 'w') as fd:
+                fd.write(todo_contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def open_side(self, side):
+        tf = TodoFile(os.path.join(self.tdir, side, "todo.txt"))
+        tf.open()
+        journal = Journal(os.path.join(self.tdir, side, "journal"))
+        journal.open()
+        journal.track(tf)
+        return tf, journal
+
+    def lines(self, side):
+        with open(os.path.join(self.tdir, side, "todo.txt")) as fd:
+            return fd.read().splitlines()
+
+    def test_record(self):
+        """saves are journaled by operation"""
+        tf, journal = self.open_side("core")
+        tf.tasks[0].do()
+        tf.tasks[1].task = "pay the rent"
+        tf.tasks[2].tags["checklist"] = "plants_complete"
+        tf.tasks.append(Task("new one"))
+        tf.save()
+        del tf.tasks[1]
+        tf.save()
+        ops = [e["op"] for e in journal.since(0)]
+        self.assertEqual(ops, ["complete", "edit", "checklist", "add", "delete"])
+        self.assertEqual(journal.seq, 5)
+        journal = Journal(journal.filename)
+        journal.open()
+        self.assertEqual(journal.seq, 5)
+
+    def test_since(self):
+        """reading from a sequence number gives only later entries"""
+        journal = Journal(os.path.join(self.tdir, "journal"))
+        journal.open()
+        for n in range(200):
+            journal.record("add", "todo.txt", new="task %d %s" % (n, "x" * (n % 17)))
+        for seen in (0, 1, 57, 198, 199, 200, 300):
+            got = [e["seq"] for e in journal.since(seen)]
+            self.assertEqual(got, range(seen + 1, 201))
+
+    def test_sync(self):
+        """a peer catches up from the journal, without echoing it"""
+        core, core_journal = self.open_side("core")
+        core.tasks[0].do()
+        core.tasks.append(Task("from core"))
+        core.save()
+
+        tablet, tablet_journal = self.open_side("tablet")
+        seen = sync(core_journal, 0, {"todo.txt": tablet}, tablet_journal)
+        self.assertEqual(seen, 2)
+        self.assertEqual(self.lines("tablet"), self.lines("core"))
+        self.assertEqual(list(tablet_journal.since(0)), [])
+
+        del core.tasks[1]
+        core.save()
+        self.assertEqual(sync(core_journal, seen, {"todo.txt": tablet}), 3)
+        self.assertEqual(self.lines("tablet"), self.lines("core"))
+        self.assertEqual(sync(core_journal, 3, {"todo.txt": tablet}), 3)
+
+    def test_conflict(self):
+        """an edit to a task that is gone adds the new version"""
+        tablet = TodoFile(os.path.join(self.tdir, "tablet", "todo.txt"))
+        tablet.open()
+        entries = [{"seq": 1, "op": "edit", "file": "todo.txt",
+                    "old": "not here", "new": "edited elsewhere"},
+                   {"seq": 2, "op": "delete", "file": "todo.txt", "old": "nope"}]
+        self.assertEqual(apply_entries(entries, {"todo.txt": tablet}), 2)
+        self.assertEqual(self.lines("tablet")[-1], "edited elsewhere")
+        self.assertEqual(len(self.lines("tablet")), 4)
@@ -0,0 +1,81 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+from todo import Task, TodoFile
+from todo_remind import TimerWheel, Reminders
+import checklists
+
+todo_contents = """2013-12-01 file taxes due:2013-12-10
+2013-12-01 call mom
+x 2013-12-02 2013-12-01 done already due:2013-12-05
+2013-12-06 weekly review checklist:review
+"""
+
+class TestWheel(unittest.TestCase):
+    def test_wheel(self):
+        wheel = TimerWheel(date(2013, 12, 1))
+        wheel.add("a", date(2013, 12, 3), 1)
+        wheel.add("b", date(2013, 12, 3), 2)
+        wheel.add("c", date(2013, 11, 1), 3)
+        wheel.add("d", date(2014, 12, 1), 4)
+        wheel.remove("b")
+        self.assertEqual(wheel.advance(date(2013, 12, 1)), [("c", 3)])
+        self.assertEqual(wheel.advance(date(2013, 12, 2)), [])
+        self.assertEqual(wheel.advance(date(2013, 12, 5)), [("a", 1)])
+        # a long gap goes by the buckets, not the days
+        self.assertEqual(wheel.advance(date(2020, 1, 1)), [("d", 4)])
+        self.assertEqual(len(wheel), 0)
+
+
+class TestReminders(unittest.TestCase):
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.todo_file = os.path.join(self.tdir, "todo.txt")
+        with open(self.todo_file, 'w') as fd:
+            fd.write(todo_contents)
+        self.tf = TodoFile(self.todo_file)
+        self.tf.open()
+        items = {"review": checklists.make_cl_item(
+                {"type": "weekly", "id": "review", "text": "weekly review",
+                 "day": "fri", "complete_time": 3})}
+        self.queue = os.path.join(self.tdir, "reminders.jsonl")
+        self.seen = []
+        self.reminders = Reminders(items, self.seen.append, self.queue,
+                                   today=date(2013, 12, 1))
+        self.reminders.attach(self.tf)
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def test_fire(self):
+        self.assertEqual(self.reminders.tick(date(2013, 12, 8)), [])
+        events = self.reminders.tick(date(2013, 12, 9))
+        self.assertEqual(events, [{"kind": "overdue", "date": "2013-12-09",
+                "task": "2013-12-06 weekly review checklist:review",
+                "checklist": "review"}])
+        self.reminders.tick(date(2013, 12, 10))
+        self.assertEqual([e["kind"] for e in self.seen], ["overdue", "due"])
+        with open(self.queue) as fd:
+            self.assertEqual([json.loads(l) for l in fd], self.seen)
+        # nothing fires twice
+        self.assertEqual(self.reminders.tick(date(2013, 12, 20)), [])
+
+    def test_changes(self):
+        """task changes and saves move reminders"""
+        self.tf.tasks[0].do()
+        self.tf.tasks[1].tags['due'] = '2013-12-04'
+        self.tf.tasks[1].changed()
+        self.tf.tasks.append(Task.parse("2013-12-01 new due:2013-12-03"))
+        del self.tf.tasks[3]
+        self.tf.save()
+        events = self.reminders.tick(date(2013, 12, 31))
+        self.assertEqual([(e["date"], e["task"]) for e in events],
+                         [("2013-12-03", "2013-12-01 new due:2013-12-03"),
+                          ("2013-12-04", "2013-12-01 call mom due:2013-12-04")])
+
+if __name__ == '__main__':
+    unittest.main()
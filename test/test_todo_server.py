@@ -0,0 +1,110 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+
+from todo_server import TodoServer
+
+todo_contents = """(A) call mom @phone
+pay rent +home
+"""
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tdir, "todo.txt"), 'w') as fd:
+            fd.write(todo_contents)
+        with open(os.path.join(self.tdir, "done.txt"), 'w') as fd:
+            fd.write("x 2013-12-01 old thing\n")
+        self.server = TodoServer(("127.0.0.1", 0), {"home": self.tdir}, quiet=True)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = "http://127.0.0.1:%d" % (self.server.server_address[1],)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tdir)
+
+    def request(self, path, body=None, headers=None):
+        data = json.dumps(body) if body is not None else None
+        req = urllib2.Request(self.base + path, data, headers or {})
+        try:
+            resp = urllib2.urlopen(req)
+        except urllib2.HTTPError as e:
+            return e.code, e.read(), e.headers
+        return resp.getcode(), resp.read(), resp.headers
+
+    def lines(self, path):
+        return [t["line"] for t in json.loads(self.request(path)[1])]
+
+    def test_list(self):
+        status, body, headers = self.request("/")
+        self.assertEqual(json.loads(body), ["home"])
+        self.assertEqual(self.lines("/home/tasks"),
+                         ["(A) call mom @phone", "pay rent +home"])
+        self.assertEqual(self.lines("/home/tasks?project=home"), ["pay rent +home"])
+        self.assertEqual(self.lines("/home/tasks?file=all&done=1"),
+                         ["x 2013-12-01 old thing"])
+        self.assertEqual(self.request("/away/tasks")[0], 404)
+
+    def test_etag(self):
+        """unchanged files get a 304, changed ones a fresh list"""
+        status, body, headers = self.request("/home/tasks")
+        etag = headers["ETag"]
+        status, body, headers = self.request("/home/tasks",
+                headers={"If-None-Match": etag})
+        self.assertEqual(status, 304)
+
+        with open(os.path.join(self.tdir, "todo.txt"), 'a') as fd:
+            fd.write("new from elsewhere\n")
+        status, body, headers = self.request("/home/tasks",
+                headers={"If-None-Match": etag})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)[-1]["line"], "new from elsewhere")
+
+    def test_add_do(self):
+        status, body, headers = self.request("/home/tasks", {"line": "walk dog"})
+        self.assertEqual(status, 201)
+        added = json.loads(body)
+        self.assertEqual(added["n"], 2)
+        self.assertTrue(added["create"])
+
+        status, body, headers = self.request("/home/tasks/0/do",
+                {"line": "pay rent +home"})
+        self.assertEqual(status, 409)
+        status, body, headers = self.request("/home/tasks/1/do",
+                {"line": "pay rent +home"})
+        self.assertEqual(status, 200)
+        self.assertTrue(json.loads(body)["done"])
+        with open(os.path.join(self.tdir, "todo.txt")) as fd:
+            lines = fd.read().splitlines()
+        self.assertTrue(lines[1].startswith("x "))
+        self.assertTrue(lines[2].endswith("walk dog"))
+
+    def test_bad_body(self):
+        self.assertEqual(self.request("/home/tasks", ["walk dog"])[0], 400)
+        self.assertEqual(self.request("/home/tasks/1/do", "pay rent")[0], 400)
+        for line in (5, None, "x"):
+            self.assertEqual(self.request("/home/tasks", {"line": line})[0], 400)
+        self.assertEqual(self.request("/home/tasks/1/do", {"line": 5})[0], 400)
+        self.assertEqual(self.request("/home/tasks/1/do", {"line": "x"})[0], 400)
+        self.assertEqual(self.request("/home/tasks/7/do", {})[0], 404)
+        self.assertEqual(len(self.lines("/home/tasks")), 2)
+
+    def test_checklist_process(self):
+        with open(os.path.join(self.tdir, "checklist.json"), 'w') as fd:
+            json.dump([{"type": "daily", "id": "plants", "text": "water plants"}], fd)
+        status, body, headers = self.request("/home/checklist/process", {})
+        self.assertEqual(status, 200)
+        lines = self.lines("/home/tasks?tag=checklist=plants")
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith("water plants checklist:plants"))
+
+if __name__ == '__main__':
+    unittest.main()
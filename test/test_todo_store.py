@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from todo import Task, TodoFile
+from todo_store import TaskStore
+
+todo_contents = """(A) call mom
+pay rent +home
+water plants checklist:plants
+"""
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.todo_file = os.path.join(self.tdir, "todo.txt")
+        with open(self.todo_file, 'w') as fd:
+            fd.write(todo_contents)
+        self.store = TaskStore(TodoFile(self.todo_file))
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def test_snapshots(self):
+        """snapshots don't see writes, the next one does, and it is saved"""
+        before = self.store.snapshot()
+        with self.store.write() as tx:
+            tx.edit(1).do()
+            tx.add(Task("new one"))
+            tx.remove(0)
+        after = self.store.snapshot()
+        self.assertEqual([str(t) for t in before], todo_contents.splitlines())
+        self.assertFalse(before[1].done)
+        self.assertEqual(len(after), 3)
+        self.assertTrue(after[0].done)
+        # untouched tasks are shared
+        self.assertTrue(after[1] is before[2])
+        self.assertEqual(after.version, before.version + 1)
+
+        tf = TodoFile(self.todo_file)
+        tf.open()
+        self.assertEqual([str(t) for t in tf.tasks], [str(t) for t in after])
+
+    def test_merge_edits(self):
+        """edited copies merge and journal as edits of their tasks"""
+        from todo_journal import Journal
+        tf = TodoFile(self.todo_file, merge=True, lazy=True)
+        store = TaskStore(tf)
+        journal = Journal(os.path.join(self.tdir, "todo.journal"))
+        journal.track(tf)
+        with open(self.todo_file, 'a') as fd:
+            fd.write("added elsewhere\n")
+        with store.write() as tx:
+            tx.edit(0).do()
+        lines = [str(t) for t in store.snapshot()]
+        self.assertEqual(lines[1:], ["pay rent +home", "water plants checklist:plants",
+                                     "added elsewhere"])
+        self.assertTrue(lines[0].startswith("x "))
+        # the line merged in from disk is new to the journal as well
+        self.assertEqual([e["op"] for e in journal.since(0)], ["complete", "add"])
+        # lazy tasks are finished before they are shared
+        self.assertTrue(all(t._rest is None for t in store.snapshot()))
+
+    def test_failed_write(self):
+        try:
+            with self.store.write() as tx:
+                tx.remove(0)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(len(self.store.snapshot()), 3)
+        self.assertEqual(self.store.snapshot().version, 0)
+
+    def test_threads(self):
+        """readers always see a whole version"""
+        stop = []
+        errors = []
+        def read():
+            while not stop:
+                snap = self.store.snapshot()
+                values = set(t.tags.get('v') for t in snap)
+                if len(values) != 1:
+                    errors.append(values)
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for r in readers:
+            r.start()
+        try:
+            for n in range(20):
+                with self.store.write() as tx:
+                    for task in tx.edit_where(lambda t: True):
+                        task.tags['v'] = str(n)
+        finally:
+            stop.append(True)
+            for r in readers:
+                r.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.store.snapshot().version, 20)
+
+if __name__ == '__main__':
+    unittest.main()
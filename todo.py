@@ -1,6 +1,13 @@
+import os
 import re
-import subprocess
+import errno
+import hashlib
+from contextlib import contextmanager
 from datetime import datetime as DT, date
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 CONFIG_FILE="~/.todo.cfg"
 
@@ -8,9 +15,15 @@ _tagTest = re.compile(r'.+:.+')
 _prioTest = re.compile(r'\([A-Z]\)$')
 _validPrio = re.compile(r'[A-Z]')
 
+_dateTest = re.compile(r'(\d{4})-(\d\d)-(\d\d)$')
+
 def _makeDate(word):
     if word is None: return None
     if isinstance(word, date): return word
+    # strptime is slow, and every line has a word or two tried as a date
+    m = _dateTest.match(word)
+    if m:
+        return date(*map(int, m.groups()))
     return DT.strptime(word, "%Y-%m-%d").date()
 
 def _isDate(word):
@@ -35,22 +48,50 @@ def _isContext(word):
 def _isTag(word):
     return bool(_tagTest.search(word))
 
+_env_cache = {}
+
+def _started_from_config(cfg):
+    """True if todo.sh, having sourced cfg, is the one running us"""
+    started = os.environ.get("TODOTXT_CFG_FILE")
+    if not started:
+        return False
+    try:
+        return os.path.samefile(os.path.expanduser(started), os.path.expanduser(cfg))
+    except OSError:
+        return False
+
 def get_todo_env(key):
-    cmd = ". %s; echo $%s"
-    cmd %= (CONFIG_FILE, key)
-    var = subprocess.check_output([cmd], shell=True)
-    return var.strip()
+    # todo.sh exports its settings to add-ons, so don't fork a shell to
+    # source the same config again
+    if key in os.environ and _started_from_config(CONFIG_FILE):
+        return os.environ[key]
+
+    try:
+        mtime = os.stat(os.path.expanduser(CONFIG_FILE)).st_mtime
+    except OSError:
+        mtime = None
+    ckey = (CONFIG_FILE, mtime, key)
+    if ckey not in _env_cache:
+        import subprocess
+        cmd = ". %s; echo $%s"
+        cmd %= (CONFIG_FILE, key)
+        var = subprocess.check_output([cmd], shell=True)
+        _env_cache[ckey] = var.strip()
+    return _env_cache[ckey]
 
 class Task(object):
     def __init__(self, task="", projects=None, contexts=None, tags=None, autodate=False):
+        self._hash = None
+        # words after the dates, when parsed lazily and not yet decoded
+        self._rest = None
         self.priority = ''
         self._create = None
         self._finish = None
         self.task = task
         self.done = False
-        self.projects = projects if projects else list()
-        self.contexts = contexts if contexts else list()
-        self.tags = tags if tags else dict()
+        self._projects = projects if projects else list()
+        self._contexts = contexts if contexts else list()
+        self._tags = tags if tags else dict()
 
         if autodate:
             self.create = date.today()
@@ -58,11 +99,138 @@ class Task(object):
     # can "undo" - pass false
     def do(self, value=True):
         if bool(value):
-            self.done = True
+            self._done = True
             self.finish = DT.now().date()
         else:
-            self.done = False
+            self._done = False
             self.finish = None
+        self._notify()
+
+    def watch(self, callback):
+        """Have callback called with this task after do(), changed() or a
+        change to its text, done state, priority or dates"""
+        if '_watchers' not in self.__dict__:
+            self._watchers = []
+        self._watchers.append(callback)
+
+    def unwatch(self, callback):
+        if callback in self.__dict__.get('_watchers', ()):
+            self._watchers.remove(callback)
+
+    def copy(self):
+        """A copy with its own projects, contexts and tags, and no
+        watchers"""
+        task = Task(self.task, list(self.projects), list(self.contexts),
+                    dict(self.tags))
+        task.done = self.done
+        task.priority = self.priority
+        task.create = self.create
+        task.finish = self.finish
+        return task
+
+    def changed(self):
+        """Call after changing projects, contexts or tags in place - the
+        other fields notice their own changes"""
+        self._notify()
+
+    def _notify(self):
+        self._hash = None
+        for callback in self.__dict__.get('_watchers', ()):
+            callback(self)
+
+    def _decode(self):
+        """Sort the words left by a lazy parse into text, projects, contexts
+        and tags. The fields are filled in before the words are let go, so
+        anything that sees _rest cleared sees the whole task"""
+        bare_words, tokens = self._rest
+        words = list(bare_words)
+        for word in tokens:
+            if _isProject(word):
+                self._projects.append(word)
+            elif _isContext(word):
+                self._contexts.append(word)
+            elif _isTag(word):
+                k, v = word.partition(":")[::2]
+                self._tags[k] = v
+            else:
+                words.append(word)
+        self._task = " ".join(words)
+        self._rest = None
+
+    @property
+    def task(self):
+        if self._rest is not None:
+            self._decode()
+        return self._task
+
+    @task.setter
+    def task(self, value):
+        if self._rest is not None:
+            self._decode()
+        self._task = value
+        self._notify()
+
+    @property
+    def projects(self):
+        if self._rest is not None:
+            self._decode()
+        return self._projects
+
+    @projects.setter
+    def projects(self, value):
+        if self._rest is not None:
+            self._decode()
+        self._projects = value
+
+    @property
+    def contexts(self):
+        if self._rest is not None:
+            self._decode()
+        return self._contexts
+
+    @contexts.setter
+    def contexts(self, value):
+        if self._rest is not None:
+            self._decode()
+        self._contexts = value
+
+    @property
+    def tags(self):
+        if self._rest is not None:
+            self._decode()
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        if self._rest is not None:
+            self._decode()
+        self._tags = value
+
+    @property
+    def done(self):
+        return self._done
+
+    @done.setter
+    def done(self, value):
+        self._done = value
+        self._notify()
+
+    def content_hash(self):
+        """A stable hash (sha1 hex) of what the task says: done, priority
+        (open tasks only, as done ones aren't written with it), dates, text,
+        and projects, contexts and tags in any order. Cached until the task
+        changes"""
+        if self._hash is None:
+            fields = ["x" if self.done else "",
+                      "" if self.done else self.priority,
+                      str(self.create or ""), str(self.finish or ""), self.task]
+            fields.extend(sorted(self.projects))
+            fields.append("")
+            fields.extend(sorted(self.contexts))
+            fields.append("")
+            fields.extend(sorted("%s:%s" % kv for kv in self.tags.iteritems()))
+            self._hash = hashlib.sha1("\0".join(fields)).hexdigest()
+        return self._hash
 
     @property
     def priority(self):
@@ -72,6 +240,7 @@ class Task(object):
     def priority(self, value):
         if not value:
             self._priority = ""
+            self._notify()
             return
 
         value = value.upper()
@@ -81,6 +250,7 @@ class Task(object):
             self._priority = "(%s)" % value
         else:
             raise Exception('Bad prio')
+        self._notify()
 
     @property
     def create(self):
@@ -89,6 +259,7 @@ class Task(object):
     @create.setter
     def create(self, val):
         self._create = _makeDate(val)
+        self._notify()
 
     @property
     def finish(self):
@@ -97,6 +268,7 @@ class Task(object):
     @finish.setter
     def finish(self, val):
         self._finish = _makeDate(val)
+        self._notify()
 
     def __str__(self):
         # Question - strip prio as option?
@@ -118,7 +290,11 @@ class Task(object):
         return " ".join(v for v in tok if v)
 
     @staticmethod
-    def parse(todoline):
+    def parse(todoline, lazy=False):
+        """Parse a todo line, None if it is blank. With lazy, only the done
+        mark, priority and dates are read up front - the rest of the line is
+        sorted into text, projects, contexts and tags the first time one of
+        them is used, which saves time for scans that never look"""
         leading_space=False
         bare_words = []
         task = Task()
@@ -154,35 +330,756 @@ class Task(object):
             task.create = tokens.pop(0)
 
         # Now the meat
-        for word in tokens:
-            if _isProject(word):
-                task.projects.append(word)
-            elif _isContext(word):
-                task.contexts.append(word)
-            elif _isTag(word):
-                k, v = word.partition(":")[::2]
-                task.tags[k] = v
-            else:
-                bare_words.append(word)
-        task.task = " ".join(bare_words)
+        task._rest = (bare_words, tokens)
+        if not lazy:
+            task._decode()
         return task
 
 
+@contextmanager
+def _locked(filename, exclusive):
+    """Hold an advisory lock for filename (on filename.lock, so the file
+    itself can be rewritten freely) - shared for reading, exclusive for
+    writing. No-op where fcntl isn't available, for an unnamed file, or
+    where the lock file can't be created (e.g. a read-only or missing
+    directory)"""
+    if fcntl is None or not filename:
+        yield
+        return
+    try:
+        fd = os.open(filename + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS, errno.ENOENT):
+            raise
+        yield
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+def _file_id(fd):
+    st = os.fstat(fd.fileno())
+    return (st.st_ino, st.st_size, st.st_mtime)
+
 class TodoFile(object):
-    def __init__(self, filename=""):
+    def __init__(self, filename="", merge=False, lazy=False):
         self.filename = filename
+        # merge with changes made on disk since open() when saving, rather
+        # than overwriting them
+        self.merge = merge
+        # parse tasks lazily (see Task.parse)
+        self.lazy = lazy
+        # byte offset of each task's line, as of the last open or save
+        self.offsets = []
+        # called with the TodoFile after every save, e.g. to keep indexes
+        # up to date
+        self.listeners = []
+        # line each task had at the last open or save, and the file it
+        # came from, for merging
+        self._orig = {}
+        # ids of the tasks in file order, as of the last open or save
+        self._ids = []
+        # id of each task standing in for another until the next save has
+        # been seen by listeners (see substitute)
+        self.substituted = {}
+        self._disk = None
+        # offset and sha1 of the last line of the file, to tell if it has
+        # only been appended to since (see refresh)
+        self._tail = None
 
     def __str__(self):
         return "\n".join(str(task) for task in self.tasks) + "\n"
 
+    # set operations, by Task.content_hash
+
+    def union(self, other):
+        """Tasks here, then those in other that aren't here"""
+        here = set(task.content_hash() for task in self.tasks)
+        return self.tasks + [task for task in other.tasks
+                             if task.content_hash() not in here]
+
+    def difference(self, other):
+        """Tasks here that aren't in other"""
+        there = set(task.content_hash() for task in other.tasks)
+        return [task for task in self.tasks if task.content_hash() not in there]
+
+    def duplicates(self):
+        """Lists of tasks that say the same thing, for each thing said more
+        than once, in file order"""
+        groups = {}
+        order = []
+        for task in self.tasks:
+            h = task.content_hash()
+            if h not in groups:
+                groups[h] = []
+                order.append(h)
+            groups[h].append(task)
+        return [groups[h] for h in order if len(groups[h]) > 1]
+
+    def edit_script(self, other):
+        """The fewest deletes and adds that turn the tasks here into the
+        tasks in other, order aside: ("delete", index here, task) for tasks
+        not (or not as many times) in other, then ("add", index in other,
+        task) for the ones missing here"""
+        counts = {}
+        for task in other.tasks:
+            h = task.content_hash()
+            counts[h] = counts.get(h, 0) + 1
+        script = []
+        for n, task in enumerate(self.tasks):
+            h = task.content_hash()
+            if counts.get(h):
+                counts[h] -= 1
+            else:
+                script.append(("delete", n, task))
+        for n, task in enumerate(other.tasks):
+            h = task.content_hash()
+            if counts.get(h):
+                counts[h] -= 1
+                script.append(("add", n, task))
+        return script
+
+    def _remember(self, lines):
+        # tasks are kept as well as ids, so ids can't be reused
+        self._orig = dict((id(task), (task, line))
+                for task, line in zip(self.tasks, lines))
+        self._ids = [id(task) for task in self.tasks]
+
+    def substitute(self, pairs):
+        """Record that each (old, new) pair's new task (e.g. an edited copy)
+        has taken old's place in tasks, so a merging save treats it as old
+        changed rather than old deleted and new added. Listeners of the next
+        save can find old as substituted[id(new)]"""
+        moved = {}
+        for old, new in pairs:
+            self.substituted[id(new)] = old
+            if id(old) in self._orig:
+                self._orig[id(new)] = (new, self._orig.pop(id(old))[1])
+                moved[id(old)] = id(new)
+        if moved:
+            self._ids = [moved.get(tid, tid) for tid in self._ids]
+
+    def _in_step(self):
+        """True if tasks are still the ones last read or saved, in the same
+        order and unchanged, so they can stand in for the file's lines"""
+        if getattr(self, 'tasks', None) is None:
+            return False
+        if [id(task) for task in self.tasks] != self._ids:
+            return False
+        for task in self.tasks:
+            now, line = str(task), self._orig[id(task)][1]
+            # lines aren't always written the way str() writes them
+            if now != line and now != str(Task.parse(line)):
+                return False
+        return True
+
+    def _set_tail(self, end, line):
+        if line is None:
+            self._tail = None
+        else:
+            self._tail = (end - len(line), hashlib.sha1(line).hexdigest())
+
     def open(self):
+        self.tasks = []
+        self.offsets = []
+        self._orig = {}
+        self._ids = []
+        self._disk = None
+        self._tail = None
+        try:
+            # only the read happens under the lock, parsing is done after
+            with _locked(self.filename, False):
+                with open(self.filename, 'r') as fd:
+                    raw = fd.readlines()
+                    self._disk = _file_id(fd)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        self._remember(self._read_lines(raw, 0))
+
+    def _read_lines(self, raw, offset):
+        """Parse raw lines starting at offset onto the end of tasks, and
+        return the lines of the tasks added"""
+        lines = []
+        for line in raw:
+            stripped = line.strip()
+            task = Task.parse(stripped, self.lazy)
+            if task is not None:
+                self.tasks.append(task)
+                self.offsets.append(offset)
+                lines.append(stripped)
+            offset += len(line)
+        if raw:
+            self._set_tail(offset, raw[-1])
+        return lines
+
+    def _only_appended(self, fd, disk):
+        """True if the file in fd is the one last read, with lines added on
+        the end and nothing else changed"""
+        ino, size, mtime = self._disk
+        if disk[0] != ino or disk[1] <= size:
+            return False
+        if self._tail is None:
+            return size == 0
+        offset, digest = self._tail
+        fd.seek(offset)
+        tail = fd.read(size - offset)
+        return tail.endswith("\n") and hashlib.sha1(tail).hexdigest() == digest
+
+    def refresh(self):
+        """Catch up with changes to the file. If it has only been appended
+        to since the last open, save or refresh (same inode, bigger, and the
+        last line read still there unchanged) only the new lines are read
+        and their tasks added. Anything else opens it again, which drops
+        unsaved changes. Returns the number of tasks read"""
+        if getattr(self, 'tasks', None) is None or self._disk is None:
+            self.open()
+            return len(self.tasks)
+        raw = None
+        try:
+            with _locked(self.filename, False):
+                with open(self.filename, 'r') as fd:
+                    disk = _file_id(fd)
+                    if disk == self._disk:
+                        return 0
+                    if self._only_appended(fd, disk):
+                        fd.seek(self._disk[1])
+                        raw = fd.readlines()
+        except IOError:
+            pass
+        if raw is None:
+            self.open()
+            return len(self.tasks)
+        start = len(self.tasks)
+        lines = self._read_lines(raw, self._disk[1])
+        for task, line in zip(self.tasks[start:], lines):
+            self._orig[id(task)] = (task, line)
+            self._ids.append(id(task))
+        self._disk = disk
+        return len(lines)
+
+    def _merged(self, fd):
+        """Local changes since open() applied on top of the file as it is on
+        disk now: tasks deleted here are dropped, tasks changed here replace
+        their old line, and new tasks go at the end. A task changed here whose
+        old line is gone from disk is added at the end, so when both sides
+        changed a task both versions are kept"""
+        current = set(id(task) for task in self.tasks)
+        deleted = {}
+        for tid, (task, line) in self._orig.iteritems():
+            if tid not in current:
+                deleted[line] = deleted.get(line, 0) + 1
+        ours = {}
+        for task in self.tasks:
+            if id(task) in self._orig:
+                ours.setdefault(self._orig[id(task)][1], []).append(task)
+
+        merged = []
+        placed = set()
+        for line in fd:
+            line = line.strip()
+            if deleted.get(line):
+                deleted[line] -= 1
+            elif ours.get(line):
+                task = ours[line].pop(0)
+                placed.add(id(task))
+                merged.append(task)
+            else:
+                task = Task.parse(line)
+                if task is not None:
+                    merged.append(task)
+        for task in self.tasks:
+            if id(task) in placed:
+                continue
+            if id(task) not in self._orig or str(task) != self._orig[id(task)][1]:
+                merged.append(task)
+        return merged
+
+    def save(self, merge=None):
+        if merge is None:
+            merge = self.merge
+        lines = [str(task) for task in self.tasks]
+        with _locked(self.filename, True):
+            if merge and self._disk is not None:
+                try:
+                    with open(self.filename, 'r') as fd:
+                        if _file_id(fd) != self._disk:
+                            self.tasks = self._merged(fd)
+                            lines = [str(task) for task in self.tasks]
+                except IOError:
+                    pass
+            with open(self.filename, 'w') as fd:
+                fd.write("".join(line + "\n" for line in lines) or "\n")
+                fd.flush()
+                self._disk = _file_id(fd)
+        self._set_tail(self._disk[1], lines[-1] + "\n" if lines else "\n")
+        self._remember(lines)
+        self.offsets = []
+        offset = 0
+        for line in lines:
+            self.offsets.append(offset)
+            offset += len(line) + 1
+        for listener in self.listeners:
+            listener(self)
+        self.substituted = {}
+
+    # bulk edits, straight on the file
+
+    def _edit_where(self, predicate, edit):
+        """One streaming pass over the file: lines whose task matches
+        predicate are replaced by edit(task), or dropped when it returns
+        None, everything else is copied as it is. If this TodoFile is open,
+        matches the file and has no unsaved changes (nothing added, removed,
+        moved or edited), its tasks are the ones edited (nothing is parsed)
+        and it stays in step, and listeners are called. Otherwise the lines
+        are parsed and the TodoFile is left as it is. Returns the number of
+        tasks that matched"""
+        import tempfile
+        count = 0
+        with _locked(self.filename, True):
+            try:
+                fd = open(self.filename, 'r')
+            except IOError:
+                return 0
+            with fd:
+                mode = os.fstat(fd.fileno()).st_mode & 0o7777
+                loaded = self._disk == _file_id(fd) and self._in_step()
+                tmp = tempfile.NamedTemporaryFile('w',
+                        dir=os.path.dirname(self.filename) or ".",
+                        prefix=".edit", delete=False)
+                try:
+                    kept, lines, offsets = [], [], []
+                    offset = 0
+                    n = 0
+                    last = None
+                    for line in fd:
+                        stripped = line.strip()
+                        if not stripped:
+                            tmp.write(line)
+                            offset += len(line)
+                            last = line
+                            continue
+                        if loaded:
+                            task = self.tasks[n]
+                            n += 1
+                        else:
+                            task = Task.parse(stripped, lazy=True)
+                        if predicate(task):
+                            count += 1
+                            task = edit(task)
+                            if task is None:
+                                continue
+                            stripped = str(task)
+                            line = stripped + "\n"
+                        elif not line.endswith("\n"):
+                            line += "\n"
+                        tmp.write(line)
+                        last = line
+                        if loaded:
+                            kept.append(task)
+                            lines.append(stripped)
+                            offsets.append(offset)
+                        offset += len(line)
+                    if not count:
+                        tmp.close()
+                        os.remove(tmp.name)
+                        return 0
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                    disk = _file_id(tmp)
+                    tmp.close()
+                    os.chmod(tmp.name, mode)
+                    os.rename(tmp.name, self.filename)
+                except:
+                    tmp.close()
+                    if os.path.exists(tmp.name):
+                        os.remove(tmp.name)
+                    raise
+        if loaded:
+            self.tasks = kept
+            self.offsets = offsets
+            self._remember(lines)
+            self._disk = disk
+            self._set_tail(offset, last)
+            for listener in self.listeners:
+                listener(self)
+        return count
+
+    def update_where(self, predicate, update=None, **fields):
+        """Set fields (e.g. priority="A") on the tasks matching predicate,
+        and call update with each if given, in one pass over the file.
+        Returns the number of tasks changed"""
+        def edit(task):
+            for name, value in fields.iteritems():
+                setattr(task, name, value)
+            if update is not None:
+                update(task)
+            task.changed()
+            return task
+        return self._edit_where(predicate, edit)
+
+    def complete_where(self, predicate):
+        """Complete the open tasks matching predicate, in one pass over the
+        file. Returns the number completed"""
+        def edit(task):
+            task.do()
+            return task
+        return self._edit_where(lambda task: not task.done and predicate(task), edit)
+
+    def delete_where(self, predicate):
+        """Remove the tasks matching predicate, in one pass over the file.
+        Returns the number removed"""
+        return self._edit_where(predicate, lambda task: None)
+
+
+def archive(todo_name, done_name, bufsize=1 << 16):
+    """Move completed tasks from todo_name to the end of done_name, like
+    todo.sh archive. todo_name is streamed once, so memory use doesn't
+    depend on its size: open lines are copied as they are to a new file
+    that replaces todo_name at the end, completed ones are appended to
+    done_name in buffered chunks. If anything fails before the replace,
+    done_name is cut back, so tasks never end up in both files. Returns the
+    number of tasks moved"""
+    import tempfile
+    moved = 0
+    with _locked(todo_name, True), _locked(done_name, True):
         try:
-            with open(self.filename, 'r') as fd:
-                self.tasks = [Task.parse(x.strip()) for x in fd.readlines()]
-            self.tasks = [x for x in self.tasks if x is not None]
+            st = os.stat(todo_name)
+        except OSError:
+            return 0
+        tmp = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(todo_name) or ".",
+                prefix=".archive", delete=False)
+        done = open(done_name, 'a+')
+        done.seek(0, os.SEEK_END)
+        done_size = done.tell()
+        try:
+            if done_size:
+                done.seek(done_size - 1)
+                if done.read(1) != "\n":
+                    done.write("\n")
+            pending = []
+            pending_size = 0
+            with open(todo_name, 'r') as fd:
+                for line in fd:
+                    if line.startswith("x "):
+                        if not line.endswith("\n"):
+                            line += "\n"
+                        pending.append(line)
+                        pending_size += len(line)
+                        moved += 1
+                        if pending_size >= bufsize:
+                            done.write("".join(pending))
+                            pending, pending_size = [], 0
+                    else:
+                        tmp.write(line)
+            if not moved:
+                # nothing to do, leave todo_name alone
+                done.truncate(done_size)
+                tmp.close()
+                os.remove(tmp.name)
+                return 0
+            done.write("".join(pending))
+            done.flush()
+            os.fsync(done.fileno())
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            tmp.close()
+            os.chmod(tmp.name, st.st_mode & 0o7777)
+            os.rename(tmp.name, todo_name)
         except:
-            self.tasks = []
+            done.truncate(done_size)
+            tmp.close()
+            if os.path.exists(tmp.name):
+                os.remove(tmp.name)
+            raise
+        finally:
+            done.close()
+    return moved
+
+
+
+# streaming filter, for use in pipelines: python -m todo [options] [files]
+
+def _tag_arg(value):
+    k, sep, v = value.partition("=")
+    return k, (v if sep else None)
+
+def make_filter_args():
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m todo",
+            description="Filter and rewrite todo.txt lines, one at a time")
+    parser.add_argument("files", nargs="*",
+            help="files to read, stdin if none (or -)")
+    parser.add_argument("--from", dest="input", default="todo",
+            choices=("todo", "jsonl", "csv"), help="format to read (default todo)")
+    parser.add_argument("--to", dest="output", default="todo",
+            choices=("todo", "jsonl", "csv"), help="format to write (default todo)")
+    parser.add_argument("-a", "--all", action="store_true",
+            help="pass lines that don't match through unchanged instead of dropping them")
+
+    state = parser.add_mutually_exclusive_group()
+    state.add_argument("--done", dest="done", action="store_const", const=True,
+            help="only completed tasks")
+    state.add_argument("--open", dest="done", action="store_const", const=False,
+            help="only open tasks")
+    parser.add_argument("-p", "--priority",
+            help="only tasks with one of these priorities, e.g. A or ABC ('-' for none)")
+    parser.add_argument("--project", action="append", default=[],
+            help="only tasks in this +project (repeatable, all must match)")
+    parser.add_argument("--context", action="append", default=[],
+            help="only tasks with this @context (repeatable, all must match)")
+    parser.add_argument("--tag", action="append", default=[], type=_tag_arg,
+            help="only tasks with tag key, or key=value (repeatable, all must match)")
+    for field in ("created", "finished"):
+        parser.add_argument("--%s-from" % field, type=_makeDate, metavar="DATE",
+                help="only tasks %s on or after DATE" % field)
+        parser.add_argument("--%s-to" % field, type=_makeDate, metavar="DATE",
+                help="only tasks %s on or before DATE" % field)
+
+    parser.add_argument("--set-priority", metavar="PRIO",
+            help="give matching tasks this priority ('-' to remove it)")
+    parser.add_argument("--set-tag", action="append", default=[], type=_tag_arg,
+            metavar="KEY=VALUE", help="set a tag on matching tasks")
+    parser.add_argument("--del-tag", action="append", default=[], metavar="KEY",
+            help="remove a tag from matching tasks")
+    parser.add_argument("--add-project", action="append", default=[],
+            help="add a +project to matching tasks")
+    parser.add_argument("--add-context", action="append", default=[],
+            help="add an @context to matching tasks")
+    parser.add_argument("--do", action="store_true",
+            help="mark matching tasks done today")
+    return parser
+
+def _prefixed(mark, name):
+    return name if name.startswith(mark) else mark + name
+
+def _in_range(d, low, high):
+    if low is None and high is None:
+        return True
+    if d is None:
+        return False
+    return (low is None or d >= low) and (high is None or d <= high)
+
+def task_matcher(args):
+    """A function saying whether a task passes the filter options in args"""
+    prios = None
+    if args.priority is not None:
+        prios = set("" if p == "-" else "(%s)" % p for p in args.priority.upper())
+    projects = [_prefixed("+", p) for p in args.project]
+    contexts = [_prefixed("@", c) for c in args.context]
+
+    def matches(task):
+        if args.done is not None and task.done != args.done:
+            return False
+        if prios is not None and task.priority not in prios:
+            return False
+        if not _in_range(task.create, args.created_from, args.created_to):
+            return False
+        if not _in_range(task.finish, args.finished_from, args.finished_to):
+            return False
+        # the header checks above don't need the rest of a lazy task
+        if projects and not all(p in task.projects for p in projects):
+            return False
+        if contexts and not all(c in task.contexts for c in contexts):
+            return False
+        for k, v in args.tag:
+            if k not in task.tags or (v is not None and task.tags[k] != v):
+                return False
+        return True
+    return matches
+
+def task_rewriter(args):
+    """A function applying the rewrite options in args to a task, or None if
+    there are none"""
+    if not (args.set_priority is not None or args.set_tag or args.del_tag or
+            args.add_project or args.add_context or args.do):
+        return None
+
+    def rewrite(task):
+        if args.set_priority is not None:
+            task.priority = "" if args.set_priority == "-" else args.set_priority
+        for k, v in args.set_tag:
+            task.tags[k] = v or ""
+        for k in args.del_tag:
+            task.tags.pop(k, None)
+        for p in args.add_project:
+            p = _prefixed("+", p)
+            if p not in task.projects:
+                task.projects.append(p)
+        for c in args.add_context:
+            c = _prefixed("@", c)
+            if c not in task.contexts:
+                task.contexts.append(c)
+        if args.do and not task.done:
+            task.do()
+        task.changed()
+    return rewrite
+
+def _filtered(lines, args):
+    """(line, task) for each line to output. task is None for blank lines
+    passed through, and line is None when the task was rewritten"""
+    matches = task_matcher(args)
+    rewrite = task_rewriter(args)
+    for line in lines:
+        if not line.endswith("\n"):
+            line += "\n"
+        task = Task.parse(line.strip(), lazy=True)
+        if task is None or not matches(task):
+            if args.all:
+                yield line, task
+            continue
+        if rewrite is None:
+            yield line, task
+        else:
+            rewrite(task)
+            yield None, task
+
+def filter_lines(lines, args):
+    """Yield the output lines (newline ended) for the input lines. Matching
+    lines that aren't rewritten come out as they went in"""
+    for line, task in _filtered(lines, args):
+        yield line if line is not None else str(task) + "\n"
+
+
+# conversion to and from json lines and csv, a task at a time
+
+RECORD_FIELDS = ("done", "priority", "create", "finish", "task", "projects",
+                 "contexts", "tags")
+
+def task_record(task):
+    """The fields of a task as a dict of json friendly values"""
+    return {"done": task.done, "priority": task.priority[1:2],
+            "create": str(task.create) if task.create else None,
+            "finish": str(task.finish) if task.finish else None,
+            "task": task.task, "projects": task.projects,
+            "contexts": task.contexts, "tags": task.tags}
+
+def _bytes(value):
+    # todo files are bytes, json gives back unicode
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+def record_task(record):
+    """A Task from a dict like task_record gives"""
+    task = Task(_bytes(record.get("task") or ""),
+                [_bytes(p) for p in record.get("projects") or ()],
+                [_bytes(c) for c in record.get("contexts") or ()],
+                dict((_bytes(k), _bytes(v)) for k, v in
+                     (record.get("tags") or {}).iteritems()))
+    task.done = bool(record.get("done"))
+    task.priority = _bytes(record.get("priority") or "")
+    task.create = _bytes(record.get("create") or None)
+    task.finish = _bytes(record.get("finish") or None)
+    return task
+
+def tasks_to_jsonl(tasks):
+    import json
+    for task in tasks:
+        yield json.dumps(task_record(task), sort_keys=True) + "\n"
+
+def jsonl_to_tasks(lines):
+    import json
+    for line in lines:
+        if line.strip():
+            yield record_task(json.loads(line))
+
+class _Rows(list):
+    # lets csv.writer write into a list
+    write = list.append
+
+def tasks_to_csv(tasks):
+    """csv lines with a header row. projects, contexts and tags are space
+    separated, tags as key:value"""
+    import csv
+    rows = _Rows()
+    writer = csv.writer(rows, lineterminator="\n")
+    writer.writerow(RECORD_FIELDS)
+    yield rows.pop()
+    for task in tasks:
+        writer.writerow([int(task.done), task.priority[1:2],
+                         task.create or "", task.finish or "", task.task,
+                         " ".join(task.projects), " ".join(task.contexts),
+                         " ".join("%s:%s" % kv for kv in task.tags.iteritems())])
+        yield rows.pop()
+
+def csv_to_tasks(lines):
+    import csv
+    for row in csv.DictReader(lines):
+        record = dict(row)
+        record["done"] = row["done"] == "1"
+        record["projects"] = row["projects"].split()
+        record["contexts"] = row["contexts"].split()
+        record["tags"] = dict(t.partition(":")[::2] for t in row["tags"].split())
+        yield record_task(record)
+
+def todo_to_tasks(lines):
+    for line in lines:
+        task = Task.parse(line.strip())
+        if task is not None:
+            yield task
+
+def tasks_to_todo(tasks):
+    for task in tasks:
+        yield str(task) + "\n"
+
+# format: (tasks to lines, lines to tasks)
+formats = {
+    "todo": (tasks_to_todo, todo_to_tasks),
+    "jsonl": (tasks_to_jsonl, jsonl_to_tasks),
+    "csv": (tasks_to_csv, csv_to_tasks),
+}
+
+def write_buffered(out, lines, bufsize=1 << 16):
+    """Write lines to out in chunks of about bufsize"""
+    pending = []
+    pending_size = 0
+    for line in lines:
+        pending.append(line)
+        pending_size += len(line)
+        if pending_size >= bufsize:
+            out.write("".join(pending))
+            pending, pending_size = [], 0
+    out.write("".join(pending))
+    out.flush()
+
+def convert(src, dst, from_fmt="todo", to_fmt="jsonl", bufsize=1 << 16):
+    """Stream tasks from the file src in from_fmt to the file dst in to_fmt
+    (formats are the keys of formats), a line at a time"""
+    tasks = formats[from_fmt][1](src)
+    write_buffered(dst, formats[to_fmt][0](tasks), bufsize)
+
+def _input_lines(files):
+    import sys
+    for name in files or ["-"]:
+        if name == "-":
+            for line in sys.stdin:
+                yield line
+        else:
+            with open(name, 'r') as fd:
+                for line in fd:
+                    yield line
+
+def main(argv=None, bufsize=1 << 16):
+    import sys
+    args = make_filter_args().parse_args(argv)
+    lines = _input_lines(args.files)
+    if args.input != "todo":
+        lines = tasks_to_todo(formats[args.input][1](lines))
+    if args.output == "todo":
+        out = filter_lines(lines, args)
+    else:
+        out = formats[args.output][0](task for line, task in _filtered(lines, args)
+                                      if task is not None)
+    try:
+        write_buffered(sys.stdout, out, bufsize)
+    except IOError as e:
+        # the reader went away (e.g. | head), which is fine
+        if e.errno != errno.EPIPE:
+            raise
 
-    def save(self):
-        with open(self.filename, 'w') as fd:
-            fd.write(str(self))
+if __name__ == '__main__':
+    main()
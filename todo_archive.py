@@ -0,0 +1,212 @@
+"""Block compressed archives of todo.txt formatted files, for big and mostly
+cold done.txt history.
+
+The archive is a series of independently compressed blocks of lines - for
+gzip (.gz) and bz2 (.bz2) that is just a multi-member file, so zcat/bzcat
+still read it whole. A sidecar index (<archive>.idx) records where each block
+starts, how many lines it holds, the range of dates in it and the checklist
+ids it has tasks for, so reading a date range or finding checklist tasks only
+decompresses the blocks that matter."""
+
+import os
+import bz2
+import json
+import zlib
+
+from todo import Task
+
+# gzip framing for zlib
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def _gzip_compress(data):
+    c = zlib.compressobj(9, zlib.DEFLATED, _GZIP_WBITS)
+    return c.compress(data) + c.flush()
+
+codecs = {
+    "gzip": (_gzip_compress, lambda: zlib.decompressobj(_GZIP_WBITS)),
+    "bz2": (lambda data: bz2.compress(data, 9), bz2.BZ2Decompressor),
+}
+
+def codec_for(filename):
+    if filename.endswith(".bz2"):
+        return "bz2"
+    return "gzip"
+
+def _task_date(task):
+    d = task.finish or task.create
+    return str(d) if d else None
+
+
+class BlockArchive(object):
+    def __init__(self, filename, block_lines=1000):
+        self.filename = filename
+        self.index_file = filename + ".idx"
+        self.codec = codec_for(filename)
+        self.block_lines = block_lines
+        self.blocks = []
+        self._tasks = None
+
+    def open(self):
+        """Load the block index, rebuilding it if it is missing or doesn't
+        match the archive"""
+        self._tasks = None
+        size = os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+        try:
+            with open(self.index_file, 'r') as fd:
+                index = json.load(fd)
+            if index["size"] != size:
+                raise ValueError("stale index")
+            self.blocks = index["blocks"]
+        except (IOError, ValueError, KeyError):
+            self.rebuild_index()
+
+    def _write_index(self):
+        size = os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+        tmp = self.index_file + ".tmp"
+        with open(tmp, 'w') as fd:
+            json.dump({"size": size, "codec": self.codec, "blocks": self.blocks}, fd)
+        os.rename(tmp, self.index_file)
+
+    def _block_info(self, offset, size, first, lines):
+        dates = []
+        checklist = {}
+        for line in lines:
+            task = Task.parse(line)
+            if task is None:
+                continue
+            d = _task_date(task)
+            if d:
+                dates.append(d)
+            if 'checklist' in task.tags:
+                clid = task.tags['checklist'].partition('_')[0]
+                create = str(task.create) if task.create else ""
+                if create >= checklist.get(clid, ""):
+                    checklist[clid] = create
+        return {"offset": offset, "size": size, "first": first,
+                "lines": len(lines), "start": min(dates) if dates else None,
+                "end": max(dates) if dates else None, "checklist": checklist}
+
+    def rebuild_index(self):
+        """Find the block boundaries by walking the compressed members"""
+        self.blocks = []
+        if not os.path.exists(self.filename):
+            self._write_index()
+            return
+        make_decomp = codecs[self.codec][1]
+        offset = 0
+        first = 0
+        with open(self.filename, 'rb') as fd:
+            pending = ""
+            while True:
+                # decompress one member, feeding it until data is left over
+                d = make_decomp()
+                text = []
+                consumed = 0
+                chunk = pending or fd.read(1 << 16)
+                pending = ""
+                while chunk:
+                    try:
+                        text.append(d.decompress(chunk))
+                    except EOFError:
+                        # bz2 member ended right at the end of the last chunk
+                        pending = chunk
+                        break
+                    consumed += len(chunk)
+                    if d.unused_data:
+                        pending = d.unused_data
+                        consumed -= len(pending)
+                        break
+                    chunk = fd.read(1 << 16)
+                if not consumed:
+                    break
+                size = consumed
+                lines = "".join(text).splitlines()
+                self.blocks.append(self._block_info(offset, size, first, lines))
+                first += len(lines)
+                offset += size
+        self._write_index()
+
+    def read_block(self, n):
+        """The lines in block n"""
+        block = self.blocks[n]
+        with open(self.filename, 'rb') as fd:
+            fd.seek(block["offset"])
+            data = fd.read(block["size"])
+        return codecs[self.codec][1]().decompress(data).splitlines()
+
+    def append(self, tasks):
+        """Add tasks (or todo lines) to the end of the archive in new blocks"""
+        lines = [str(t) for t in tasks if t is not None and str(t).strip()]
+        if not lines:
+            return
+        compress = codecs[self.codec][0]
+        first = sum(b["lines"] for b in self.blocks)
+        with open(self.filename, 'ab') as fd:
+            fd.seek(0, os.SEEK_END)
+            for n in range(0, len(lines), self.block_lines):
+                chunk = lines[n:n + self.block_lines]
+                data = compress("\n".join(chunk) + "\n")
+                offset = fd.tell()
+                fd.write(data)
+                self.blocks.append(self._block_info(offset, len(data), first, chunk))
+                first += len(chunk)
+        self._write_index()
+        self._tasks = None
+
+    def __iter__(self):
+        for n in range(len(self.blocks)):
+            for line in self.read_block(n):
+                task = Task.parse(line)
+                if task is not None:
+                    yield task
+
+    @property
+    def tasks(self):
+        """All tasks, like TodoFile.tasks - this reads every block"""
+        if self._tasks is None:
+            self._tasks = list(self)
+        return self._tasks
+
+    def __len__(self):
+        return sum(b["lines"] for b in self.blocks)
+
+    def tasks_between(self, start, end):
+        """Tasks finished (or created, when there is no finish date) between
+        the start and end dates inclusive, reading only overlapping blocks"""
+        start, end = str(start), str(end)
+        for n, block in enumerate(self.blocks):
+            if block["start"] is None or block["start"] > end or block["end"] < start:
+                continue
+            for line in self.read_block(n):
+                task = Task.parse(line)
+                if task is None:
+                    continue
+                d = _task_date(task)
+                if d and start <= d <= end:
+                    yield task
+
+    def latest_checklist_tasks(self, ids=None):
+        """The latest task for each checklist id (or only those in ids), as
+        checklist processing wants them, reading only the blocks that hold
+        one"""
+        wanted = {}
+        for n, block in enumerate(self.blocks):
+            for clid, create in block["checklist"].iteritems():
+                if ids is not None and clid not in ids:
+                    continue
+                if clid not in wanted or create >= wanted[clid][0]:
+                    wanted[clid] = (create, n)
+
+        latest = {}
+        for n in sorted(set(n for c, n in wanted.itervalues())):
+            for line in self.read_block(n):
+                task = Task.parse(line)
+                if task is None or 'checklist' not in task.tags:
+                    continue
+                clid = task.tags['checklist'].partition('_')[0]
+                if clid not in wanted or wanted[clid][1] != n:
+                    continue
+                create = str(task.create) if task.create else ""
+                if clid not in latest or create >= str(latest[clid].create or ""):
+                    latest[clid] = task
+        return latest
@@ -0,0 +1,195 @@
+"""A cache of parsed todo files that many processes can read at once, e.g.
+pre-forked web workers, without each parsing and keeping its own copy.
+
+The tasks of a file are encoded into a cache file that readers mmap, so the
+pages are shared between them. Tasks are built from the decoded fields when
+they are used, and nothing is parsed again. The cache files go in /dev/shm
+where it exists (memory backed), otherwise the temp directory.
+
+One process (the one that writes the todo files, or a timer) calls
+publish() to bring the cache up to date. Readers call open(), which gives
+None when there is no cache for the file's current state, or tasks() to fall
+back to parsing in that case.
+
+The format of a cache file is a header (magic, inode, size and mtime of the
+todo file, task count), a table of count + 1 record offsets, then a record
+per task: done, priority letter, create and finish ordinals (0 for none)
+and the text, projects, contexts and tags, separated by control
+characters."""
+
+import os
+import mmap
+import struct
+import hashlib
+import tempfile
+from datetime import date
+
+from todo import Task, TodoFile
+
+MAGIC = "TDC1"
+_HEADER = struct.Struct("<4sQQdI")
+_OFFSET = struct.Struct("<I")
+_RECORD = struct.Struct("<B1sII")
+
+# field, list item and tag key/value separators - none can be in a task
+_FIELD, _ITEM, _KV = "\x1f", "\x1e", "\x1d"
+
+def _default_dir():
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+def _source_id(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+def encode_task(task):
+    fields = [task.task, _ITEM.join(task.projects), _ITEM.join(task.contexts),
+              _ITEM.join(k + _KV + v for k, v in task.tags.iteritems())]
+    return _RECORD.pack(int(task.done), task.priority[1:2] or " ",
+                        task.create.toordinal() if task.create else 0,
+                        task.finish.toordinal() if task.finish else 0) + \
+           _FIELD.join(fields)
+
+def decode_task(data):
+    done, prio, create, finish = _RECORD.unpack_from(data)
+    text, projects, contexts, tags = data[_RECORD.size:].split(_FIELD)
+    task = Task(text, projects.split(_ITEM) if projects else [],
+                contexts.split(_ITEM) if contexts else [],
+                dict(t.split(_KV, 1) for t in tags.split(_ITEM)) if tags else {})
+    task.done = bool(done)
+    task.priority = prio.strip()
+    task.create = date.fromordinal(create) if create else None
+    task.finish = date.fromordinal(finish) if finish else None
+    return task
+
+
+class CachedTasks(object):
+    """A read only sequence of the tasks in a cache file. Tasks are decoded
+    on access, so keep the ones you want rather than indexing again"""
+
+    def __init__(self, fd, mm):
+        self._fd = fd
+        self._mm = mm
+        magic, ino, size, mtime, self.count = _HEADER.unpack_from(mm)
+        self.source = (ino, size, mtime)
+        self._table = _HEADER.size
+
+    def _offset(self, n):
+        return _OFFSET.unpack_from(self._mm, self._table + n * _OFFSET.size)[0]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.count
+        if not 0 <= n < self.count:
+            raise IndexError(n)
+        return decode_task(self._mm[self._offset(n):self._offset(n + 1)])
+
+    def __iter__(self):
+        for n in xrange(self.count):
+            yield self[n]
+
+    def close(self):
+        self._mm.close()
+        self._fd.close()
+
+
+class TaskCache(object):
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or _default_dir()
+
+    def cache_file(self, filename):
+        key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+        return os.path.join(self.cache_dir, "todo-%s.tasks" % (key,))
+
+    def _cached_source(self, filename):
+        try:
+            with open(self.cache_file(filename), 'rb') as fd:
+                header = fd.read(_HEADER.size)
+        except IOError:
+            return None
+        if len(header) < _HEADER.size or header[:4] != MAGIC:
+            return None
+        return _HEADER.unpack(header)[1:4]
+
+    def publish(self, filename, tasks=None):
+        """Write the cache for filename if it is out of date, from tasks if
+        given (they must be what the file holds now, e.g. right after a
+        TodoFile save), otherwise by parsing it. Returns True if it wrote"""
+        source = _source_id(filename)
+        if source is None:
+            return False
+        if self._cached_source(filename) == source:
+            return False
+        if tasks is None:
+            tf = TodoFile(filename)
+            tf.open()
+            tasks = tf.tasks
+
+        records = [encode_task(t) for t in tasks]
+        table = []
+        offset = _HEADER.size + _OFFSET.size * (len(records) + 1)
+        for rec in records:
+            table.append(offset)
+            offset += len(rec)
+        table.append(offset)
+
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=".todo-cache")
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(_HEADER.pack(MAGIC, source[0], source[1], source[2],
+                                       len(records)))
+                out.write("".join(_OFFSET.pack(o) for o in table))
+                out.write("".join(records))
+            # readers that have the old one mapped keep it until they close
+            os.rename(tmp, self.cache_file(filename))
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return True
+
+    def attach(self, todofile):
+        """Publish whenever todofile is saved"""
+        todofile.listeners.append(lambda tf: self.publish(tf.filename, tf.tasks))
+
+    def open(self, filename):
+        """CachedTasks for filename, or None if the cache is missing or
+        older than the file"""
+        try:
+            fd = open(self.cache_file(filename), 'rb')
+        except IOError:
+            return None
+        try:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            fd.close()
+            return None
+        if mm[:4] != MAGIC:
+            mm.close()
+            fd.close()
+            return None
+        cached = CachedTasks(fd, mm)
+        if cached.source != _source_id(filename):
+            cached.close()
+            return None
+        return cached
+
+    def tasks(self, filename):
+        """The tasks of filename, from the cache when it is current and
+        otherwise by parsing the file"""
+        cached = self.open(filename)
+        if cached is None:
+            tf = TodoFile(filename)
+            tf.open()
+            return tf.tasks
+        try:
+            return list(cached)
+        finally:
+            cached.close()
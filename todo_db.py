@@ -0,0 +1,208 @@
+"""An optional sqlite mirror of todo.txt formatted files, for reporting over
+a lot of history without re-parsing the text every time. The text files stay
+the real data - changes made through here are written back with TodoFile so
+todo.sh keeps working."""
+
+import os
+import sqlite3
+
+from todo import Task, TodoFile
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    inode INTEGER,
+    tail_offset INTEGER,
+    tail TEXT,
+    count INTEGER
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    done INTEGER NOT NULL,
+    priority TEXT,
+    created TEXT,
+    finished TEXT,
+    text TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS tasks_pos ON tasks (file, pos);
+CREATE INDEX IF NOT EXISTS tasks_done ON tasks (done);
+CREATE INDEX IF NOT EXISTS tasks_priority ON tasks (priority);
+CREATE INDEX IF NOT EXISTS tasks_created ON tasks (created);
+CREATE INDEX IF NOT EXISTS tasks_finished ON tasks (finished);
+CREATE TABLE IF NOT EXISTS projects (
+    task_id INTEGER NOT NULL REFERENCES tasks(id) ON DELETE CASCADE,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS projects_name ON projects (name);
+CREATE INDEX IF NOT EXISTS projects_task ON projects (task_id);
+CREATE TABLE IF NOT EXISTS contexts (
+    task_id INTEGER NOT NULL REFERENCES tasks(id) ON DELETE CASCADE,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS contexts_name ON contexts (name);
+CREATE INDEX IF NOT EXISTS contexts_task ON contexts (task_id);
+CREATE TABLE IF NOT EXISTS tags (
+    task_id INTEGER NOT NULL REFERENCES tasks(id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS tags_key ON tags (key, value);
+CREATE INDEX IF NOT EXISTS tags_task ON tags (task_id);
+"""
+
+def _datestr(d):
+    return str(d) if d else None
+
+
+class TodoDB(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = None
+
+    def open(self):
+        self.db = sqlite3.connect(self.filename)
+        # todo files are bytes, keep them that way
+        self.db.text_factory = str
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+        self.db = None
+
+    def _state(self, name):
+        return self.db.execute("""SELECT size, mtime, inode, tail_offset, tail,
+                count FROM files WHERE name=?""", (name,)).fetchone()
+
+    def _insert(self, name, pos, offset, line, task):
+        cur = self.db.execute("""INSERT INTO tasks (file, pos, offset, line,
+                done, priority, created, finished, text)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (name, pos, offset, line, int(task.done), task.priority[1:2],
+                 _datestr(task.create), _datestr(task.finish), task.task))
+        tid = cur.lastrowid
+        self.db.executemany("INSERT INTO projects (task_id, name) VALUES (?, ?)",
+                ((tid, p) for p in task.projects))
+        self.db.executemany("INSERT INTO contexts (task_id, name) VALUES (?, ?)",
+                ((tid, c) for c in task.contexts))
+        self.db.executemany("INSERT INTO tags (task_id, key, value) VALUES (?, ?, ?)",
+                ((tid, k, v) for k, v in task.tags.iteritems()))
+
+    def _unchanged_prefix(self, fd, state, st):
+        """True when the file only grew since the last sync"""
+        size, mtime, inode, tail_offset, tail, count = state
+        # a file that didn't grow was rewritten, even if it is the same size
+        if st.st_ino != inode or st.st_size <= size:
+            return False
+        if tail is None:
+            return size == 0
+        # a tail without a newline may have been extended in place
+        if not tail.endswith("\n"):
+            return False
+        fd.seek(tail_offset)
+        return fd.read(len(tail)) == tail
+
+    def sync(self, filename):
+        """Bring the mirror of filename up to date. Appended lines are parsed
+        on their own, anything else reloads the file. Returns the number of
+        tasks read"""
+        name = os.path.abspath(filename)
+        try:
+            st = os.stat(name)
+        except OSError:
+            st = None
+
+        state = self._state(name)
+        if st is None:
+            with self.db:
+                self.db.execute("DELETE FROM tasks WHERE file=?", (name,))
+                self.db.execute("DELETE FROM files WHERE name=?", (name,))
+            return 0
+        if state is not None and state[:3] == (st.st_size, st.st_mtime, st.st_ino):
+            return 0
+
+        read = 0
+        with open(name, 'rb') as fd, self.db:
+            if state is not None and self._unchanged_prefix(fd, state, st):
+                offset, tail_offset, tail, pos = state[0], state[3], state[4], state[5]
+            else:
+                self.db.execute("DELETE FROM tasks WHERE file=?", (name,))
+                offset, tail_offset, tail, pos = 0, 0, None, 0
+            fd.seek(offset)
+            for line in fd:
+                task = Task.parse(line.strip())
+                if task is not None:
+                    self._insert(name, pos, offset, line.rstrip("\n"), task)
+                    pos += 1
+                    read += 1
+                tail_offset, tail = offset, line
+                offset += len(line)
+            self.db.execute("""INSERT OR REPLACE INTO files (name, size, mtime,
+                    inode, tail_offset, tail, count) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (name, offset, st.st_mtime, st.st_ino, tail_offset, tail, pos))
+        return read
+
+    def tasks(self, where="", params=()):
+        """Yield (id, Task) for the mirrored tasks matching an sql condition
+        on the tasks table, in file order"""
+        sql = "SELECT id, line FROM tasks"
+        if where:
+            sql += " WHERE " + where
+        sql += " ORDER BY file, pos"
+        for tid, line in self.db.execute(sql, params):
+            yield tid, Task.parse(line)
+
+    def with_project(self, project):
+        return self.tasks("id IN (SELECT task_id FROM projects WHERE name=?)",
+                (project,))
+
+    def with_context(self, context):
+        return self.tasks("id IN (SELECT task_id FROM contexts WHERE name=?)",
+                (context,))
+
+    def with_tag(self, key, value=None):
+        if value is None:
+            return self.tasks("id IN (SELECT task_id FROM tags WHERE key=?)",
+                    (key,))
+        return self.tasks("id IN (SELECT task_id FROM tags WHERE key=? AND value=?)",
+                (key, value))
+
+    # writing back through TodoFile
+
+    def _locate(self, tid):
+        row = self.db.execute("SELECT file, pos, line FROM tasks WHERE id=?",
+                (tid,)).fetchone()
+        if row is None:
+            raise KeyError(tid)
+        name, pos, line = row
+        tf = TodoFile(name)
+        tf.open()
+        if pos >= len(tf.tasks) or str(tf.tasks[pos]) != str(Task.parse(line)):
+            raise ValueError("%s changed since it was last synced" % (name,))
+        return tf, pos
+
+    def add(self, filename, task):
+        tf = TodoFile(filename)
+        tf.open()
+        tf.tasks.append(task)
+        tf.save()
+        self.sync(filename)
+
+    def update(self, tid, task):
+        tf, pos = self._locate(tid)
+        tf.tasks[pos] = task
+        tf.save()
+        self.sync(tf.filename)
+
+    def delete(self, tid):
+        tf, pos = self._locate(tid)
+        del tf.tasks[pos]
+        tf.save()
+        self.sync(tf.filename)
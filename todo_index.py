@@ -0,0 +1,361 @@
+"""Indexes over todo.txt formatted files, kept next to the file so queries
+don't have to parse every line."""
+
+import os
+import sys
+import json
+import heapq
+from bisect import bisect_left, bisect_right
+
+from todo import Task, TodoFile, _makeDate
+
+def _date_value(v):
+    return str(_makeDate(v))
+
+# how tag values of each type are stored - as something that sorts right
+tag_types = {
+    "date": _date_value,
+    "int": int,
+}
+
+
+class TagIndex(object):
+    """A sorted index of typed tag values (e.g. due:YYYY-MM-DD) to the offsets
+    of the lines that have them. keys maps tag name to a type in tag_types.
+    The index lives in <filename>.tagidx and is brought up to date on open -
+    lines appended since are indexed on their own, anything else rebuilds
+    it. attach() keeps it current across TodoFile saves."""
+
+    def __init__(self, filename, keys=None):
+        self.filename = filename
+        self.index_file = filename + ".tagidx"
+        self.keys = dict(keys) if keys else {"due": "date", "t": "date"}
+        self.values = {}
+        self.offsets = {}
+        self._state = None
+
+    def _clear(self):
+        self.values = dict((k, []) for k in self.keys)
+        self.offsets = dict((k, []) for k in self.keys)
+
+    def _entries(self, task):
+        for k, t in self.keys.iteritems():
+            if k not in task.tags:
+                continue
+            try:
+                yield k, tag_types[t](task.tags[k])
+            except (ValueError, TypeError):
+                continue
+
+    def _add(self, offset, task):
+        for k, v in self._entries(task):
+            # keep entries sorted by (value, offset)
+            vals, offs = self.values[k], self.offsets[k]
+            n = bisect_right(vals, v)
+            while n > 0 and vals[n - 1] == v and offs[n - 1] > offset:
+                n -= 1
+            vals.insert(n, v)
+            offs.insert(n, offset)
+
+    def _rebuild(self, pairs):
+        """Index (offset, task) pairs from scratch"""
+        entries = dict((k, []) for k in self.keys)
+        for offset, task in pairs:
+            for k, v in self._entries(task):
+                entries[k].append((v, offset))
+        for k, e in entries.iteritems():
+            e.sort()
+            self.values[k] = [v for v, o in e]
+            self.offsets[k] = [o for v, o in e]
+
+    def _file_state(self, tail_offset, tail):
+        st = os.stat(self.filename)
+        return {"size": st.st_size, "mtime": st.st_mtime, "inode": st.st_ino,
+                "tail_offset": tail_offset, "tail": tail}
+
+    def _appended_only(self, fd, st):
+        state = self._state
+        # a file that didn't grow was rewritten, even if it is the same size
+        if state is None or st.st_ino != state["inode"] or st.st_size <= state["size"]:
+            return False
+        tail = state["tail"]
+        if tail is None:
+            return state["size"] == 0
+        if not tail.endswith("\n"):
+            return False
+        fd.seek(state["tail_offset"])
+        return fd.read(len(tail)) == tail
+
+    def open(self):
+        self._clear()
+        self._state = None
+        try:
+            with open(self.index_file, 'r') as fd:
+                saved = json.load(fd)
+            if saved["keys"] == self.keys:
+                for k in self.keys:
+                    self.values[k] = [v for v, o in saved["index"][k]]
+                    self.offsets[k] = [o for v, o in saved["index"][k]]
+                self._state = saved["state"]
+                # json gives back unicode
+                if self._state["tail"] is not None:
+                    self._state["tail"] = self._state["tail"].encode("utf-8")
+        except (IOError, ValueError, KeyError):
+            self._clear()
+        self.refresh()
+
+    def refresh(self):
+        """Index whatever changed in the file since the index was written"""
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            self._clear()
+            self._state = None
+            return
+        state = self._state
+        if state is not None and (state["size"], state["mtime"], state["inode"]) == \
+                (st.st_size, st.st_mtime, st.st_ino):
+            return
+
+        with open(self.filename, 'rb') as fd:
+            appended = self._appended_only(fd, st)
+            if appended:
+                offset = state["size"]
+                tail_offset, tail = state["tail_offset"], state["tail"]
+            else:
+                offset, tail_offset, tail = 0, 0, None
+            fd.seek(offset)
+            pairs = []
+            for line in fd:
+                task = Task.parse(line.strip())
+                if task is not None:
+                    pairs.append((offset, task))
+                tail_offset, tail = offset, line
+                offset += len(line)
+        if appended:
+            for offset, task in pairs:
+                self._add(offset, task)
+        else:
+            self._rebuild(pairs)
+        self._state = self._file_state(tail_offset, tail)
+        self.save()
+
+    def save(self):
+        index = dict((k, zip(self.values[k], self.offsets[k])) for k in self.keys)
+        tmp = self.index_file + ".tmp"
+        with open(tmp, 'w') as fd:
+            json.dump({"keys": self.keys, "state": self._state, "index": index}, fd)
+        os.rename(tmp, self.index_file)
+
+    def _remove(self, gone):
+        """Drop the entries of the lines at offsets in gone"""
+        for k in self.keys:
+            pairs = [(v, o) for v, o in zip(self.values[k], self.offsets[k])
+                     if o not in gone]
+            self.values[k] = [v for v, o in pairs]
+            self.offsets[k] = [o for v, o in pairs]
+
+    def update(self, todofile):
+        """Bring the index in step with a TodoFile that was just saved - its
+        tasks are already parsed, so this doesn't read the file. Only lines
+        whose offset or indexed tags changed are taken out and put back in;
+        if most of them did (e.g. a line near the top went away and moved
+        everything after it), the index is rebuilt instead"""
+        old = {}
+        for k in self.keys:
+            for v, o in zip(self.values[k], self.offsets[k]):
+                old.setdefault(o, set()).add((k, v))
+        new = [(offset, task, set(self._entries(task)))
+               for offset, task in zip(todofile.offsets, todofile.tasks)]
+        changed = [(offset, task) for offset, task, entries in new
+                   if old.pop(offset, set()) != entries]
+        # what is left in old is lines that are gone
+        gone = set(old)
+        gone.update(offset for offset, task in changed)
+        if len(changed) + len(old) > len(new) // 2:
+            self._rebuild(zip(todofile.offsets, todofile.tasks))
+        else:
+            if gone:
+                self._remove(gone)
+            for offset, task in changed:
+                self._add(offset, task)
+        tail = None
+        tail_offset = 0
+        if todofile.tasks:
+            tail_offset = todofile.offsets[-1]
+            tail = str(todofile.tasks[-1]) + "\n"
+        self._state = self._file_state(tail_offset, tail)
+        self.save()
+
+    def attach(self, todofile):
+        todofile.listeners.append(self.update)
+
+    def offsets_between(self, key, low=None, high=None):
+        """Offsets of the lines whose key tag is between low and high
+        (inclusive, None for open ended), in value order"""
+        conv = tag_types[self.keys[key]]
+        vals = self.values[key]
+        start = bisect_left(vals, conv(low)) if low is not None else 0
+        end = bisect_right(vals, conv(high)) if high is not None else len(vals)
+        return self.offsets[key][start:end]
+
+    def tasks_between(self, key, low=None, high=None):
+        """Tasks whose key tag is between low and high, read straight from
+        their lines"""
+        res = []
+        with open(self.filename, 'rb') as fd:
+            for offset in self.offsets_between(key, low, high):
+                fd.seek(offset)
+                res.append(Task.parse(fd.readline().strip()))
+        return res
+
+
+def _prio_key(task):
+    """Sort key for open tasks: priority, then oldest first, undated last"""
+    rank = ord(task.priority[1]) - ord('A') if task.priority else 26
+    create = task.create.toordinal() if task.create else sys.maxint
+    return rank, create
+
+
+class PriorityIndex(object):
+    """Open tasks of a TodoFile ordered by priority ((A) first, then no
+    priority) and creation date, for top-k views without sorting everything.
+
+    It is a heap of (key, seq, task). Tracked tasks are watched, done ones
+    included, so Task.do() (and undoing it) and priority or date changes
+    push a new entry, and entries whose seq is no longer the task's current
+    one are skipped as they come off the top. New tasks go in with add(),
+    deleted ones come out with discard().
+
+    attach() follows TodoFile saves the same way, adding the tasks a save
+    brings in and discarding the ones it drops, and writes the first
+    `keep` tasks with their line offsets to <file>.prio, so top_from_file()
+    can read the top tasks of an unchanged file without parsing the rest of
+    it."""
+
+    def __init__(self, todofile, keep=100):
+        self.todofile = todofile
+        self.index_file = todofile.filename + ".prio"
+        self.keep = keep
+        self._heap = []
+        # seq of the current entry of each open task
+        self._live = {}
+        # every task watched, open or done
+        self._tracked = {}
+        self._seq = 0
+
+    def _push(self, task):
+        heapq.heappush(self._heap, (_prio_key(task), self._seq, task))
+        self._live[id(task)] = self._seq
+        self._seq += 1
+        # don't let stale entries pile up
+        if len(self._heap) > 2 * len(self._live) + 16:
+            self._heap = [e for e in self._heap if self._live.get(id(e[2])) == e[1]]
+            heapq.heapify(self._heap)
+
+    def build(self):
+        for task in self._tracked.itervalues():
+            task.unwatch(self._changed)
+        self._heap = []
+        self._live = {}
+        self._tracked = {}
+        for task in self.todofile.tasks:
+            self._tracked[id(task)] = task
+            task.watch(self._changed)
+            if not task.done:
+                self._heap.append((_prio_key(task), self._seq, task))
+                self._live[id(task)] = self._seq
+                self._seq += 1
+        heapq.heapify(self._heap)
+
+    def add(self, task):
+        if id(task) not in self._tracked:
+            self._tracked[id(task)] = task
+            task.watch(self._changed)
+        if not task.done:
+            self._push(task)
+
+    def discard(self, task):
+        if self._tracked.pop(id(task), None) is not None:
+            task.unwatch(self._changed)
+        self._live.pop(id(task), None)
+
+    def _changed(self, task):
+        if id(task) not in self._tracked:
+            return
+        if task.done:
+            self._live.pop(id(task), None)
+        else:
+            self._push(task)
+
+    def _entries(self):
+        return (e for e in self._heap if self._live.get(id(e[2])) == e[1])
+
+    def top(self, k):
+        """The k first open tasks"""
+        res = []
+        keep = []
+        while self._heap and len(res) < k:
+            entry = heapq.heappop(self._heap)
+            key, seq, task = entry
+            if self._live.get(id(task)) != seq:
+                continue
+            res.append(task)
+            keep.append(entry)
+        for entry in keep:
+            heapq.heappush(self._heap, entry)
+        return res
+
+    def __len__(self):
+        return len(self._live)
+
+    def save(self):
+        """Write the first keep open tasks' offsets as of the todo file's
+        last save"""
+        st = os.stat(self.todofile.filename)
+        offsets = dict((id(t), o) for t, o in
+                       zip(self.todofile.tasks, self.todofile.offsets))
+        first = heapq.nsmallest(self.keep, self._entries())
+        tmp = self.index_file + ".tmp"
+        with open(tmp, 'w') as fd:
+            json.dump({"size": st.st_size, "mtime": st.st_mtime,
+                       "complete": len(first) == len(self._live),
+                       "offsets": [offsets[id(t)] for key, seq, t in first]}, fd)
+        os.rename(tmp, self.index_file)
+
+    def _saved(self, todofile):
+        current = set(id(task) for task in todofile.tasks)
+        for task in todofile.tasks:
+            if id(task) not in self._tracked:
+                self.add(task)
+        for tid, task in self._tracked.items():
+            if tid not in current:
+                self.discard(task)
+        self.save()
+
+    def attach(self, todofile):
+        todofile.listeners.append(self._saved)
+
+    @staticmethod
+    def top_from_file(filename, k):
+        """The k first open tasks in filename, from its saved order when the
+        file hasn't changed since, otherwise by loading it"""
+        try:
+            with open(filename + ".prio", 'r') as fd:
+                saved = json.load(fd)
+            st = os.stat(filename)
+            if (saved["size"], saved["mtime"]) == (st.st_size, st.st_mtime) \
+                    and (k <= len(saved["offsets"]) or saved["complete"]):
+                res = []
+                with open(filename, 'rb') as fd:
+                    for offset in saved["offsets"][:k]:
+                        fd.seek(offset)
+                        res.append(Task.parse(fd.readline().strip()))
+                return res
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        tf = TodoFile(filename)
+        tf.open()
+        index = PriorityIndex(tf)
+        index.build()
+        return index.top(k)
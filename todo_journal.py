@@ -0,0 +1,199 @@
+"""An append-only journal of changes to todo files, so devices can sync by
+shipping the changes since they last looked instead of whole files.
+
+Each entry is one json line with a sequence number, the operation, the
+file it applies to (by basename, e.g. todo.txt) and the old and/or new line:
+
+    add       - new task, new line
+    delete    - task removed, old line
+    complete  - task marked done (Task.do), old and new line
+    checklist - checklist status tag changed (ChecklistItem.process)
+    edit      - any other change to a task
+
+Tasks are matched by their line, since todo.txt has no ids."""
+
+import os
+import json
+
+from todo import Task
+
+# journal kept in TODO_DIR - checklist processing records its changes there
+# when it exists
+JOURNAL_FILE = "todo.journal"
+
+
+class Journal(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.seq = 0
+        self._snapshots = {}
+
+    def open(self):
+        """Find the last sequence number"""
+        self.seq = 0
+        try:
+            with open(self.filename, 'rb') as fd:
+                fd.seek(0, os.SEEK_END)
+                end = fd.tell()
+                # the last line is all that is needed
+                back = min(end, 4096)
+                while True:
+                    fd.seek(end - back)
+                    lines = fd.read(back).splitlines()
+                    if len(lines) > 1 or back == end:
+                        break
+                    back = min(end, back * 2)
+                if lines:
+                    self.seq = json.loads(lines[-1])["seq"]
+        except IOError:
+            pass
+
+    def record(self, op, name, old=None, new=None):
+        self.seq += 1
+        entry = {"seq": self.seq, "op": op, "file": name}
+        if old is not None:
+            entry["old"] = old
+        if new is not None:
+            entry["new"] = new
+        with open(self.filename, 'ab') as fd:
+            fd.write(json.dumps(entry, sort_keys=True) + "\n")
+        return entry
+
+    @staticmethod
+    def _line_start(fd, offset):
+        """Seek to the first line starting at or after offset"""
+        fd.seek(max(offset - 1, 0))
+        if offset and fd.read(1) != "\n":
+            fd.readline()
+        return fd.tell()
+
+    def _offset_after(self, fd, seq):
+        """Offset of the first entry with a sequence number above seq, by
+        binary search over the file"""
+        fd.seek(0, os.SEEK_END)
+        low, high = 0, fd.tell()
+        while low < high:
+            mid = (low + high) // 2
+            start = self._line_start(fd, mid)
+            line = fd.readline()
+            if not line or json.loads(line)["seq"] > seq:
+                high = mid
+            else:
+                low = start + len(line)
+        return self._line_start(fd, low)
+
+    def since(self, seq):
+        """Entries after sequence number seq"""
+        try:
+            fd = open(self.filename, 'rb')
+        except IOError:
+            return
+        with fd:
+            fd.seek(self._offset_after(fd, seq))
+            for line in fd:
+                entry = json.loads(line)
+                if entry["seq"] > seq:
+                    yield entry
+
+    # recording TodoFile changes
+
+    def snapshot(self, todofile):
+        """Remember the lines of todofile as they are now"""
+        self._snapshots[todofile.filename] = dict(
+                (id(task), (task, str(task))) for task in todofile.tasks)
+
+    def track(self, todofile):
+        """Record the changes made to todofile whenever it is saved"""
+        self.snapshot(todofile)
+        todofile.listeners.append(self._saved)
+
+    def _saved(self, todofile):
+        name = os.path.basename(todofile.filename)
+        before = self._snapshots.get(todofile.filename, {})
+        seen = set()
+        for task in todofile.tasks:
+            tid = id(task)
+            if tid not in before and tid in todofile.substituted:
+                tid = id(todofile.substituted[tid])
+            seen.add(tid)
+            line = str(task)
+            if tid not in before:
+                self.record("add", name, new=line)
+                continue
+            old_task, old = before[tid]
+            if old == line:
+                continue
+            old_parsed = Task.parse(old)
+            if task.done and not old_parsed.done:
+                op = "complete"
+            elif old_parsed.tags.get('checklist') != task.tags.get('checklist'):
+                op = "checklist"
+            else:
+                op = "edit"
+            self.record(op, name, old=old, new=line)
+        for tid, (task, old) in before.iteritems():
+            if tid not in seen:
+                self.record("delete", name, old=old)
+        self.snapshot(todofile)
+
+
+def _find(tf, where, line):
+    """Position of a task with the given line, or None"""
+    for n in where.get(line, ()):
+        if tf.tasks[n] is not None and str(tf.tasks[n]) == line:
+            return n
+    return None
+
+def apply_entries(entries, todofiles, journal=None):
+    """Apply journal entries to todofiles (a dict of basename to opened
+    TodoFile) and save the ones that changed. Changes to a task that can't
+    be found add the new line, so nothing is lost. If the files are tracked
+    by a journal of their own, pass it so applying doesn't record the
+    changes again. Returns the last sequence number applied (None if there
+    were no entries)"""
+    last = None
+    # per file, where each line is in its tasks. deleted tasks are left as
+    # None until the end so positions don't move
+    wheres = {}
+    for entry in entries:
+        last = entry["seq"]
+        tf = todofiles.get(entry["file"])
+        if tf is None:
+            continue
+        if entry["file"] not in wheres:
+            where = wheres[entry["file"]] = {}
+            for n, task in enumerate(tf.tasks):
+                where.setdefault(str(task), []).append(n)
+        where = wheres[entry["file"]]
+
+        pos = None
+        if entry.get("old") is not None:
+            pos = _find(tf, where, str(Task.parse(entry["old"])))
+        new = Task.parse(entry["new"]) if entry.get("new") else None
+        if entry["op"] == "delete":
+            if pos is not None:
+                tf.tasks[pos] = None
+            continue
+        if new is None:
+            continue
+        if pos is None:
+            pos = len(tf.tasks)
+            tf.tasks.append(new)
+        else:
+            tf.tasks[pos] = new
+        where.setdefault(str(new), []).append(pos)
+
+    for name in wheres:
+        tf = todofiles[name]
+        tf.tasks = [task for task in tf.tasks if task is not None]
+        if journal is not None:
+            journal.snapshot(tf)
+        tf.save()
+    return last
+
+def sync(source, last_seen, todofiles, journal=None):
+    """Bring todofiles up to date with the changes in the source journal
+    since the peer last saw sequence number last_seen. Returns the sequence
+    number to remember for next time"""
+    last = apply_entries(source.since(last_seen), todofiles, journal)
+    return last_seen if last is None else last
@@ -0,0 +1,163 @@
+"""Reminders for tasks reaching their deadlines: open tasks with a due: tag
+on the due date, and checklist tasks on the first day they are past due
+(the day after ChecklistItem.due_date).
+
+Deadlines are days, so timers sit in a wheel of day buckets: adding,
+removing and firing a timer are each O(1), and moving the wheel on costs
+one step per day passed (or per non-empty bucket after a long gap).
+
+    reminders = Reminders(items=store.index(), queue_file="reminders.jsonl")
+    reminders.attach(todofile)
+    reminders.tick()        # e.g. from a timer, once a minute or a day
+
+Tracked tasks are watched (Task.watch), so completing one or changing its
+dates or tags moves or drops its timer, and attach() picks up tasks added
+or removed when the TodoFile is saved. Each event is passed to the
+callback and/or appended to the queue file as a json line."""
+
+import json
+from datetime import date, timedelta
+
+from todo import _makeDate
+
+
+class TimerWheel(object):
+    """Timers keyed by anything hashable, bucketed by the day they are due"""
+
+    def __init__(self, today=None):
+        # days up to and including this one have been fired
+        self.cursor = (today or date.today()).toordinal() - 1
+        self._buckets = {}
+        self._where = {}
+
+    def add(self, key, when, payload):
+        """Fire payload on day when (a date) - on the next advance if that
+        day has passed. Replaces any timer with the same key"""
+        self.remove(key)
+        day = max(when.toordinal(), self.cursor + 1)
+        self._buckets.setdefault(day, {})[key] = payload
+        self._where[key] = day
+
+    def remove(self, key):
+        day = self._where.pop(key, None)
+        if day is not None:
+            bucket = self._buckets[day]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[day]
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def __len__(self):
+        return len(self._where)
+
+    def advance(self, today):
+        """(key, payload) for every timer due up to and including today"""
+        end = today.toordinal()
+        if end - self.cursor > len(self._buckets):
+            days = sorted(d for d in self._buckets if d <= end)
+        else:
+            days = xrange(self.cursor + 1, end + 1)
+        fired = []
+        for day in days:
+            bucket = self._buckets.pop(day, None)
+            if bucket:
+                for key, payload in bucket.iteritems():
+                    del self._where[key]
+                    fired.append((key, payload))
+        self.cursor = max(self.cursor, end)
+        return fired
+
+
+class Reminders(object):
+    def __init__(self, items=None, callback=None, queue_file=None, today=None):
+        """items maps checklist id to ChecklistItem (e.g. a store's index()),
+        for checklist deadlines. Events go to callback and/or queue_file"""
+        self.items = items or {}
+        self.callback = callback
+        self.queue_file = queue_file
+        self.wheel = TimerWheel(today)
+        self._tasks = {}
+        # tasks of each attached file as of its last save
+        self._files = {}
+        # deadlines already fired, so a change that keeps one doesn't fire
+        # it again
+        self._fired = set()
+
+    def _deadlines(self, task):
+        """(kind, date) for each reminder task has"""
+        if task.done:
+            return []
+        res = []
+        if 'due' in task.tags:
+            try:
+                res.append(("due", _makeDate(task.tags['due'])))
+            except ValueError:
+                pass
+        if 'checklist' in task.tags and task.create is not None:
+            clid, status = task.tags['checklist'].partition('_')[::2]
+            item = self.items.get(clid)
+            if item is not None and not status:
+                due = item.due_date(task)
+                if due is not None:
+                    res.append(("overdue", due + timedelta(days=1)))
+        return res
+
+    def _schedule(self, task):
+        for kind in ("due", "overdue"):
+            self.wheel.remove((id(task), kind))
+        for kind, when in self._deadlines(task):
+            if (id(task), kind, when) not in self._fired:
+                self.wheel.add((id(task), kind), when, (kind, when, task))
+
+    def track(self, task):
+        if id(task) in self._tasks:
+            return
+        self._tasks[id(task)] = task
+        task.watch(self._schedule)
+        self._schedule(task)
+
+    def untrack(self, task):
+        if self._tasks.pop(id(task), None) is None:
+            return
+        task.unwatch(self._schedule)
+        for kind in ("due", "overdue"):
+            self.wheel.remove((id(task), kind))
+        self._fired = set(f for f in self._fired if f[0] != id(task))
+
+    def load(self, tasks):
+        for task in tasks:
+            self.track(task)
+
+    def _saved(self, todofile):
+        current = set(id(task) for task in todofile.tasks)
+        for task in todofile.tasks:
+            self.track(task)
+        for task in self._files.get(todofile.filename, ()):
+            if id(task) not in current:
+                self.untrack(task)
+        self._files[todofile.filename] = list(todofile.tasks)
+
+    def attach(self, todofile):
+        """Track todofile's tasks, and follow its saves"""
+        self._files[todofile.filename] = list(todofile.tasks)
+        self.load(todofile.tasks)
+        todofile.listeners.append(self._saved)
+
+    def tick(self, today=None):
+        """Fire the reminders due by today. Returns the events"""
+        events = []
+        for key, (kind, when, task) in self.wheel.advance(today or date.today()):
+            self._fired.add((id(task), kind, when))
+            event = {"kind": kind, "date": str(when), "task": str(task)}
+            if 'checklist' in task.tags:
+                event["checklist"] = task.tags['checklist'].partition('_')[0]
+            events.append(event)
+        if events and self.queue_file:
+            with open(self.queue_file, 'a') as fd:
+                fd.write("".join(json.dumps(e, sort_keys=True) + "\n" for e in events))
+        if self.callback is not None:
+            for event in events:
+                self.callback(event)
+        return events
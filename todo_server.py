@@ -0,0 +1,299 @@
+"""A small local HTTP server over one or more TODO_DIRs, so UIs can ask for
+tasks as json instead of running scripts that parse the files every time.
+
+The parsed todo.txt and done.txt of each directory stay in memory and are
+only read again when the file on disk changes (size, mtime or inode). GET
+responses carry an ETag made from those, so a client polling with
+If-None-Match gets a 304 without anything being parsed or serialized.
+
+    GET  /                          names of the directories served
+    GET  /<dir>/tasks               tasks in todo.txt (?file=done or all)
+    POST /<dir>/tasks               add {"line": "..."}, dated today
+    POST /<dir>/tasks/<n>/do        complete task n of todo.txt, optionally
+                                    checking it is still {"line": "..."}
+    POST /<dir>/checklist/process   run checklist processing on the dir
+
+/tasks takes the filters of python -m todo as query parameters: done=1/0,
+priority, project, context, tag (key or key=value), created_from,
+created_to, finished_from and finished_to. project, context and tag can be
+repeated.
+
+    python todo_server.py [--port 8377] [name=]dir ...
+
+With no directories it serves TODO_DIR from the todo.sh config."""
+
+import os
+import json
+import hashlib
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from todo import Task, TodoFile, task_matcher, task_record, _makeDate
+
+FILES = {"todo": "todo.txt", "done": "done.txt"}
+
+
+def task_json(n, task):
+    res = task_record(task)
+    res.update(n=n, line=str(task), hash=task.content_hash())
+    return res
+
+def _stat_id(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+class TaskChanged(Exception):
+    """A task isn't the line the client said it should be"""
+
+
+def _parse(line):
+    """The Task for a line a client sent, ValueError if it isn't one"""
+    if not isinstance(line, basestring):
+        raise ValueError("line must be a string")
+    if isinstance(line, unicode):
+        line = line.encode("utf-8")
+    try:
+        return Task.parse(line)
+    except (IndexError, ValueError):
+        raise ValueError("can't parse task %r" % (line,))
+
+
+class TodoDir(object):
+    """The parsed todo files of one TODO_DIR, kept up to date with the disk.
+    Everything happens under lock, as the server answers requests on
+    threads"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._files = {}
+        self._ids = {}
+
+    def _filename(self, which):
+        return os.path.join(self.path, FILES[which])
+
+    def get(self, which):
+        """The TodoFile for which ("todo" or "done"), read again only if it
+        changed on disk since it was last read or saved"""
+        with self.lock:
+            filename = self._filename(which)
+            current = _stat_id(filename)
+            if which not in self._files or self._ids[which] != current:
+                tf = TodoFile(filename, merge=True)
+                tf.open()
+                self._files[which] = tf
+                self._ids[which] = current
+            return self._files[which]
+
+    def version(self):
+        """A string that changes whenever either file does"""
+        with self.lock:
+            return repr(sorted((w, _stat_id(self._filename(w))) for w in FILES))
+
+    def save(self, which):
+        with self.lock:
+            self._files[which].save()
+            self._ids[which] = _stat_id(self._filename(which))
+
+    def add(self, line):
+        with self.lock:
+            task = _parse(line)
+            if task is None:
+                raise ValueError("empty task")
+            if task.create is None:
+                task.create = Task(autodate=True).create
+            tf = self.get("todo")
+            tf.tasks.append(task)
+            self.save("todo")
+            return tf.tasks.index(task), task
+
+    def do(self, n, line=None):
+        """Complete task n of todo.txt. If line is given and task n isn't
+        that line any more, raises TaskChanged rather than completing the
+        wrong task. LookupError if there is no task n"""
+        with self.lock:
+            tf = self.get("todo")
+            if not 0 <= n < len(tf.tasks):
+                raise LookupError("no task %d" % (n,))
+            task = tf.tasks[n]
+            if line is not None and str(task) != str(_parse(line)):
+                raise TaskChanged("task %d changed" % (n,))
+            task.do()
+            self.save("todo")
+            return n, task
+
+    def process_checklist(self):
+        import checklists
+        with self.lock:
+            store = checklists.open_item_store(
+                    os.path.join(self.path, checklists.DEFAULT_FILE))
+            checklists.process_dir(store, self.path)
+
+
+class _Filters(object):
+    """Query parameters in the shape task_matcher wants"""
+
+    def __init__(self, query):
+        def one(key):
+            return query[key][-1] if key in query else None
+        done = one("done")
+        self.done = None if done is None else done not in ("0", "false", "")
+        self.priority = one("priority")
+        self.project = query.get("project", [])
+        self.context = query.get("context", [])
+        self.tag = []
+        for tag in query.get("tag", []):
+            k, sep, v = tag.partition("=")
+            self.tag.append((k, v if sep else None))
+        for field in ("created_from", "created_to", "finished_from", "finished_to"):
+            value = one(field)
+            setattr(self, field, _makeDate(value) if value else None)
+
+
+class TodoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = "todo-server/1.0"
+
+    def _send(self, status, obj=None, etag=None):
+        body = json.dumps(obj) if obj is not None else ""
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if obj is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send(status, {"error": message})
+
+    def _route(self):
+        """(TodoDir or None, remaining path parts, query)"""
+        url = urlparse.urlsplit(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        query = urlparse.parse_qs(url.query)
+        if not parts:
+            return None, parts, query
+        return self.server.dirs.get(parts[0]), parts[1:], query
+
+    def _body(self):
+        length = int(self.headers.getheader("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def do_GET(self):
+        tdir, parts, query = self._route()
+        if tdir is None:
+            if parts or self.path.strip("/"):
+                return self._error(404, "no such directory")
+            return self._send(200, sorted(self.server.dirs))
+        if parts != ["tasks"]:
+            return self._error(404, "not found")
+
+        which = query.get("file", ["todo"])[-1]
+        if which not in FILES and which != "all":
+            return self._error(400, "file must be todo, done or all")
+        etag = '"%s"' % hashlib.sha1(tdir.version() + self.path).hexdigest()
+        if etag in [t.strip() for t in
+                    (self.headers.getheader("If-None-Match") or "").split(",")]:
+            return self._send(304, etag=etag)
+        try:
+            matches = task_matcher(_Filters(query))
+        except ValueError as e:
+            return self._error(400, str(e))
+
+        res = []
+        with tdir.lock:
+            for name in (["todo", "done"] if which == "all" else [which]):
+                for n, task in enumerate(tdir.get(name).tasks):
+                    if matches(task):
+                        entry = task_json(n, task)
+                        entry["file"] = name
+                        res.append(entry)
+        self._send(200, res, etag=etag)
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        tdir, parts, query = self._route()
+        if tdir is None:
+            return self._error(404, "no such directory")
+        try:
+            body = self._body()
+        except ValueError:
+            return self._error(400, "body must be json")
+        if not isinstance(body, dict):
+            return self._error(400, "body must be a json object")
+        try:
+            if parts == ["tasks"]:
+                n, task = tdir.add(body.get("line", ""))
+                return self._send(201, task_json(n, task))
+            if len(parts) == 3 and parts[0] == "tasks" and parts[2] == "do":
+                n, task = tdir.do(int(parts[1]), body.get("line"))
+                return self._send(200, task_json(n, task))
+            if parts == ["checklist", "process"]:
+                tdir.process_checklist()
+                return self._send(200, {"processed": True})
+        except TaskChanged as e:
+            return self._error(409, str(e))
+        except ValueError as e:
+            return self._error(400, str(e))
+        except LookupError as e:
+            return self._error(404, str(e))
+        self._error(404, "not found")
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class TodoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, dirs, quiet=False):
+        """dirs maps the name used in urls to a TODO_DIR path"""
+        BaseHTTPServer.HTTPServer.__init__(self, address, TodoHandler)
+        self.dirs = dict((name, TodoDir(path)) for name, path in dirs.iteritems())
+        self.quiet = quiet
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="serve todo files as json")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8377)
+    parser.add_argument("-c", "--config_file", default=None,
+            help="todo.sh config file to find TODO_DIR in")
+    parser.add_argument("dirs", nargs="*", help="[name=]directory to serve")
+    args = parser.parse_args(argv)
+
+    dirs = {}
+    for d in args.dirs:
+        name, sep, path = d.partition("=")
+        if not sep:
+            path = name
+            name = os.path.basename(os.path.abspath(path))
+        dirs[name] = path
+    if not dirs:
+        import todo
+        if args.config_file:
+            todo.CONFIG_FILE = args.config_file
+        path = todo.get_todo_env("TODO_DIR")
+        dirs[os.path.basename(os.path.abspath(path))] = path
+
+    server = TodoServer((args.host, args.port), dirs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""A TodoFile shared between threads: readers take snapshots, which cost
+nothing and never change, while a writer builds the next version on the
+side and publishes it in one step.
+
+    store = TaskStore(TodoFile(filename))
+    snap = store.snapshot()          # any thread, no locking
+    for task in snap: ...
+
+    with store.write() as tx:        # one writer at a time
+        tx.edit(0).do()
+        tx.add(Task("new", autodate=True))
+    # saved with TodoFile.save(), then published
+
+Tasks in a snapshot are shared with every reader and with the versions
+after it, so they must not be changed - writers change copies (see
+Transaction.edit)."""
+
+import threading
+from contextlib import contextmanager
+
+from todo import TodoFile
+
+
+class Snapshot(object):
+    """One published version of the tasks"""
+
+    def __init__(self, version, tasks):
+        self.version = version
+        self.tasks = tuple(tasks)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __getitem__(self, n):
+        return self.tasks[n]
+
+
+class Transaction(object):
+    """The next version, as a writer builds it. tasks holds the current
+    tasks - unchanged ones are shared with the snapshot, so only change
+    the ones edit() or edit_where() hand out"""
+
+    def __init__(self, snapshot):
+        self.tasks = list(snapshot.tasks)
+        self._copied = set()
+        # (original, copy) for each task edit() copied
+        self.copies = []
+
+    def edit(self, n):
+        """Task n, copied first if it is still shared"""
+        task = self.tasks[n]
+        if id(task) not in self._copied:
+            copy = self.tasks[n] = task.copy()
+            self._copied.add(id(copy))
+            self.copies.append((task, copy))
+            task = copy
+        return task
+
+    def edit_where(self, predicate):
+        """Editable copies of the tasks matching predicate, e.g. to hand to
+        process_todos"""
+        return [self.edit(n) for n, task in enumerate(self.tasks) if predicate(task)]
+
+    def add(self, task):
+        self.tasks.append(task)
+        self._copied.add(id(task))
+
+    def remove(self, n):
+        del self.tasks[n]
+
+    def __len__(self):
+        return len(self.tasks)
+
+
+def _decode_all(tasks):
+    """Finish lazily parsed tasks (see Task.parse) before they are shared,
+    so readers never decode them at the same time"""
+    for task in tasks:
+        task.task
+
+
+class TaskStore(object):
+    def __init__(self, todofile):
+        self.todofile = todofile
+        if getattr(todofile, 'tasks', None) is None:
+            todofile.open()
+        _decode_all(todofile.tasks)
+        self._write_lock = threading.Lock()
+        self._current = Snapshot(0, todofile.tasks)
+        # the TodoFile works on its own list, never the snapshot's
+        todofile.tasks = list(todofile.tasks)
+
+    def snapshot(self):
+        """The current version. Taking it is a single read, so it needs no
+        lock, and it stays the same however many versions come after"""
+        return self._current
+
+    @contextmanager
+    def write(self):
+        """A Transaction on the current version. If the block finishes, the
+        tasks are saved through the TodoFile (so a merging TodoFile merges
+        with changes on disk) and the result is published. If it raises,
+        nothing changes"""
+        with self._write_lock:
+            current = self._current
+            tx = Transaction(current)
+            yield tx
+            self.todofile.tasks = tx.tasks
+            # copies are the tasks they were made from, edited
+            self.todofile.substitute(tx.copies)
+            self.todofile.save()
+            _decode_all(self.todofile.tasks)
+            published = Snapshot(current.version + 1, self.todofile.tasks)
+            self.todofile.tasks = list(self.todofile.tasks)
+            self._current = published